@@ -1,10 +1,27 @@
 from src.pipelines.datagen import DataGenFlow
+from src.nodes.datagen import finalize_parts
+from config.config import DATA_GEN_CONFIG
 from loguru import logger
+import sys
 
 def main():
     data_gen = DataGenFlow()
     data_gen.run()
     logger.info("Data generation completed")
+
+def finalize():
+    ## merges the parts of a sharded run left behind, e.g. when the last worker failed
+    output_path = finalize_parts(
+        DATA_GEN_CONFIG.output_dir,
+        DATA_GEN_CONFIG.file_name,
+        DATA_GEN_CONFIG.shard_count * DATA_GEN_CONFIG.num_shards,
+        output_format=DATA_GEN_CONFIG.output_format,
+        compression=DATA_GEN_CONFIG.compression
+    )
+    logger.info(f"Finalize completed, output: {output_path}")
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if sys.argv[1:2] == ['finalize']:
+        finalize()
+    else:
+        main()
\ No newline at end of file
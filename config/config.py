@@ -1,3 +1,4 @@
+from pydantic import AliasChoices, Field
 from pydantic_settings import BaseSettings
 
 class DataGenConfig(BaseSettings):
@@ -7,6 +8,24 @@ class DataGenConfig(BaseSettings):
     file_name: str = 'logistics_transport_data.csv'
     base_date: str = '2023-01-01'
     range_days: int = 720
+    engine: str = 'numpy'
+    output_format: str = 'csv'
+    compression: str = 'zstd'
+    compact: bool = False
+    chunk_size: int = 0
+    num_shards: int = 1
+    ## set per pod by a Kubernetes Indexed Job (JOB_COMPLETION_INDEX) or explicitly
+    shard_index: int = Field(0, validation_alias=AliasChoices('shard_index', 'job_completion_index'))
+    shard_count: int = 1
+    ## seconds the last completion index waits for the parts of the other workers before failing
+    merge_wait_seconds: int = 3600
+    use_cache: bool = True
+    incremental: bool = False
+    until: str = ''
+    topology_path: str = 'config/topology.json'
+    validate_output: bool = True
+    ## memory mapped copy of the validated dataset in the compact schema, shared by the downstream steps
+    column_store: bool = True
 
 class PreprocessConfig(BaseSettings):
     input_filename: str = 'logistics_transport_data.csv'
@@ -16,6 +35,45 @@ class PreprocessConfig(BaseSettings):
     date_str_format: str = '%Y-%m-%d'
     filter_start_date: str = '2023-01-01'
     filter_end_date: str = '2023-12-31'
+
+class TrainingConfig(BaseSettings):
+    ## column store written by DataGenFlow for input_filename, the features go to features_dir
+    input_data_dir: str = 'data/raw'
+    input_filename: str = 'logistics_transport_data.csv'
+    features_dir: str = 'data/features'
+    ## model registry the trained models are saved to
+    models_dir: str = 'data/models'
+    date_column: str = 'operation_date'
+    target_column: str = 'value_per_ton'
+    group_columns: list[str] = ['route', 'commodity']
+    ## lag / rolling features of the training and inference flows, computed on num_threads threads
+    ## (0 uses every CPU available to the pod)
+    lags: list[int] = [7, 14, 30]
+    rolling_windows: list[int] = [7, 14, 30]
+    num_threads: int = 0
+    ## per_route trains models for every route, global a single global_model over all of them
+    mode: str = 'per_route'
+    models: list[str] = ['ridge']
+    global_model: str = 'gbm'
+    ## last days of each series held out to validate its models
+    horizon_days: int = 30
+    ## routes_per_batch / num_workers 0 size them from the CPUs available to the pod
+    routes_per_batch: int = 0
+    num_workers: int = 0
+    num_pods: int = 1
+
+class InferenceConfig(BaseSettings):
+    input_data_dir: str = 'data/raw'
+    input_filename: str = 'logistics_transport_data.csv'
+    models_dir: str = 'data/models'
+    output_dir: str = 'data/predictions'
+    ## per_route uses the best model of every route, global the global model
+    mode: str = 'per_route'
+    horizons: list[int] = [30, 60, 90, 180]
+    ## last day of history the curves start after, empty uses the last day of the data
+    cutoff_date: str = ''
     
 
-DATA_GEN_CONFIG = DataGenConfig()
\ No newline at end of file
+DATA_GEN_CONFIG = DataGenConfig()
+TRAINING_CONFIG = TrainingConfig()
+INFERENCE_CONFIG = InferenceConfig()
\ No newline at end of file
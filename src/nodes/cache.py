@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from loguru import logger
+
+## modules whose code determines the generated data
+GENERATOR_MODULES = ['datagen.py', 'storage.py', 'schema.py']
+
+
+def generator_version():
+    """
+    Hash of the generator source code, so a code change invalidates every cached dataset
+    """
+    digest = hashlib.sha256()
+    nodes_dir = os.path.dirname(os.path.abspath(__file__))
+    for module in GENERATOR_MODULES:
+        with open(os.path.join(nodes_dir, module), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def file_digest(path):
+    """
+    Hash of a data file the generation depends on, such as the topology
+    """
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+class GenerationCache:
+    """
+    Content addressed cache of generated datasets. Entries are small json manifests keyed by a
+    hash of the generation parameters and the generator code version, pointing at the output
+    on disk. An entry is only valid while the output keeps the size and mtime it was recorded with.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, params: dict) -> str:
+        payload = json.dumps({'params': params, 'version': generator_version()}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def lookup(self, key: str):
+        manifest_path = self._manifest_path(key)
+        if not os.path.exists(manifest_path):
+            return None
+
+        with open(manifest_path) as f:
+            entry = json.load(f)
+        if not os.path.exists(entry['output_path']) or _fingerprint(entry['output_path']) != entry['fingerprint']:
+            logger.info(f"Cached output {entry['output_path']} changed since it was recorded, ignoring cache entry {key[:12]}")
+            return None
+
+        logger.info(f"Cache hit {key[:12]}: reusing {entry['output_path']}")
+        return entry
+
+    def record(self, key: str, params: dict, output_path: str) -> dict:
+        entry = {
+            'key': key,
+            'params': params,
+            'version': generator_version(),
+            'output_path': output_path,
+            'fingerprint': _fingerprint(output_path),
+            'created_at': datetime.now(timezone.utc).isoformat()
+        }
+        tmp_path = f"{self._manifest_path(key)}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f, indent=2, default=str)
+        os.replace(tmp_path, self._manifest_path(key))
+        logger.info(f"Recorded cache entry {key[:12]} for {output_path}")
+
+        return entry
+
+    def _manifest_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+
+def _fingerprint(path):
+    ## total size and latest mtime, over every file of a partitioned dataset
+    if os.path.isdir(path):
+        stats = [os.stat(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names]
+    else:
+        stats = [os.stat(path)]
+    return [sum(stat.st_size for stat in stats), max((stat.st_mtime_ns for stat in stats), default=0)]
\ No newline at end of file
@@ -0,0 +1,161 @@
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from loguru import logger
+from src.nodes.storage import remove_dataset
+
+METADATA_FILE = 'metadata.json'
+EXTENSION = '.columns'
+
+
+def store_path(output_dir, file_name):
+    """
+    Path of the column store kept next to the dataset for file_name
+    """
+    stem, _ = os.path.splitext(file_name)
+    return os.path.join(output_dir, f"{stem}{EXTENSION}")
+
+
+class ColumnStore:
+    """
+    Directory holding a DataFrame as one .npy file per column plus a metadata.json with the
+    number of rows, the column order and the categories of the categorical columns (stored as
+    their integer codes; string columns are stored as categoricals). Columns are opened memory
+    mapped and read only, so steps and workers pass the path around and every process opening it
+    shares the same physical pages instead of holding its own copy of the data.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, METADATA_FILE)) as f:
+            self.metadata = json.load(f)
+
+    @classmethod
+    def write(cls, df: pd.DataFrame, path: str) -> 'ColumnStore':
+        """
+        Persist df at path, replacing what is there once every column is written. Each write is
+        staged in its own temporary directory next to path and renamed into place, so concurrent
+        writers never share files and readers see either the old store or the new one
+        """
+        tmp_path = _staging_dir(path)
+        columns = []
+        for i, (name, values) in enumerate(df.items()):
+            file_name = f"{i:04d}.npy"
+            if isinstance(values.dtype, pd.CategoricalDtype) or pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+                values = values if isinstance(values.dtype, pd.CategoricalDtype) else values.astype('category')
+                np.save(os.path.join(tmp_path, file_name), values.cat.codes.to_numpy())
+                columns.append({'name': name, 'file': file_name, 'categories': values.cat.categories.tolist()})
+            else:
+                np.save(os.path.join(tmp_path, file_name), values.to_numpy())
+                columns.append({'name': name, 'file': file_name})
+
+        _replace_store(tmp_path, path, len(df), columns)
+        logger.info(f"Wrote {len(df)} rows x {len(columns)} columns to column store {path}")
+
+        return cls(path)
+
+    def append(self, df: pd.DataFrame) -> 'ColumnStore':
+        """
+        Store with the rows of df added after the existing ones, staged and renamed into place like
+        write. Only the new rows are converted: the existing columns are copied over as they are,
+        categories new to a column are added after its existing ones so the stored codes still hold
+        """
+        if list(df.columns) != self.columns:
+            raise ValueError(f"Columns {list(df.columns)} do not match the columns {self.columns} of column store {self.path}")
+
+        tmp_path = _staging_dir(self.path)
+        num_rows = self.num_rows + len(df)
+        columns = []
+        for column, (name, values) in zip(self.metadata['columns'], df.items()):
+            column = dict(column)
+            if 'categories' in column:
+                new_categories = sorted(set(values.dropna().astype(object).unique()).difference(column['categories']))
+                column['categories'] = [*column['categories'], *new_categories]
+                values = pd.Categorical(values, categories=column['categories']).codes
+            else:
+                values = values.to_numpy()
+            ## codes widen when the new categories no longer fit their integer type
+            existing = self.column(name)
+            merged = np.lib.format.open_memmap(os.path.join(tmp_path, column['file']), mode='w+',
+                                               dtype=np.result_type(existing.dtype, values.dtype), shape=(num_rows,))
+            merged[:self.num_rows] = existing
+            merged[self.num_rows:] = values
+            merged.flush()
+            del merged
+            columns.append(column)
+
+        _replace_store(tmp_path, self.path, num_rows, columns)
+        logger.info(f"Appended {len(df)} rows to column store {self.path}, {num_rows} rows")
+
+        return ColumnStore(self.path)
+
+    @property
+    def columns(self) -> list:
+        return [column['name'] for column in self.metadata['columns']]
+
+    @property
+    def num_rows(self) -> int:
+        return self.metadata['num_rows']
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        Read only memory mapped array of a column (the codes for a categorical)
+        """
+        return np.load(os.path.join(self.path, self._column(name)['file']), mmap_mode='r')
+
+    def categories(self, name: str) -> list:
+        """
+        Categories of a categorical column, the values its codes stand for
+        """
+        column = self._column(name)
+        if 'categories' not in column:
+            raise ValueError(f"Column {name} of column store {self.path} is not categorical")
+        return column['categories']
+
+    def to_frame(self, columns: list = None, start: int = 0, stop: int = None) -> pd.DataFrame:
+        """
+        DataFrame of rows start..stop-1 of columns (all by default) backed by the memory mapped
+        files, nothing is read until the values are used and nothing is copied
+        """
+        data = {}
+        for name in self.columns if columns is None else columns:
+            column = self._column(name)
+            values = self.column(name)[start:stop]
+            if 'categories' in column:
+                values = pd.Categorical.from_codes(values, categories=column['categories'], validate=False)
+            data[name] = values
+        return pd.DataFrame(data, copy=False)
+
+    def _column(self, name: str) -> dict:
+        for column in self.metadata['columns']:
+            if column['name'] == name:
+                return column
+        raise ValueError(f"Column {name} not found in column store {self.path}")
+
+
+def _staging_dir(path):
+    ## each write gets its own temporary directory next to path, so concurrent writers never share files
+    parent, store_name = os.path.split(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix=f".{store_name}.", suffix='.tmp')
+    ## mkdtemp creates the directory private to its owner
+    os.chmod(tmp_path, 0o755)
+    return tmp_path
+
+
+def _replace_store(tmp_path, path, num_rows, columns):
+    with open(os.path.join(tmp_path, METADATA_FILE), 'w') as f:
+        json.dump({'num_rows': num_rows, 'columns': columns}, f, default=str)
+    ## a directory cannot be renamed over a non empty one: move the old store aside first
+    old_path = None
+    if os.path.exists(path):
+        parent, store_name = os.path.split(os.path.abspath(path))
+        old_path = tempfile.mkdtemp(dir=parent, prefix=f".{store_name}.", suffix='.old')
+        os.replace(path, os.path.join(old_path, store_name))
+    os.replace(tmp_path, path)
+    if old_path:
+        remove_dataset(old_path)
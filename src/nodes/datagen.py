@@ -1,125 +1,151 @@
+import json
 import random
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import numpy as np
 import os
+import time
 from loguru import logger
+from src.nodes.storage import DatasetWriter, check_format, dataset_path, last_value, read_chunks, remove_dataset
+from src.nodes.schema import compact_frame
+
+EARTH_RADIUS_KM = 6371.0088
+
+ENGINES = ('numpy', 'python')
+
+## rows are drawn in blocks of BLOCK_SIZE, each block from its own streams (one per field)
+## derived from the seed and the block index, so any range of rows can be generated on its own
+BLOCK_SIZE = 65_536
+STREAM_FIELDS = (
+    'municipality', 'commodity', 'port', 'season', 'tonnage', 'base_cost', 'fixed_cost', 'fuel_factor',
+    'port_factor', 'cost_noise', 'price'
+)
+## first spawn key entry of each stream family, so the families never share a stream
+STREAM_ROWS, STREAM_DAYS, STREAM_INCREMENTAL = 0, 1, 2
+
+ROOT_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+## ports, municipalities, commodities and per state commodity weights
+TOPOLOGY_PATH = os.path.join(ROOT_DIR, 'config', 'topology.json')
+
+
+def resolve_path(path):
+    """
+    Absolute path for a path given relative to the repository root, as the config defaults are
+    """
+    return os.path.join(ROOT_DIR, path) if not os.path.isabs(path) else path
+
 
 class DataGenerator:
-    def __init__(self, num_operations, seed, output_dir, file_name, base_date, range_days: int = 730):
+    def __init__(self, num_operations, seed, output_dir, file_name, base_date, range_days: int = 730, engine: str = 'numpy', chunk_size: int = 0,
+                 output_format: str = 'csv', compression: str = 'zstd', compact: bool = False, topology_path: str = TOPOLOGY_PATH):
         self.num_operations = num_operations
         self.seed = seed
         self.output_dir = output_dir
         self.file_name = file_name
         self.base_date = base_date
         self.range_days = range_days
+        self.engine = engine
+        self.chunk_size = chunk_size
+        self.output_format = output_format
+        self.compression = compression
+        self.compact = compact
+        self.topology_path = topology_path
+        self.output_path = dataset_path(output_dir, file_name, output_format)
+        self._check_engine()
         self._set_seed()
         self._check_dirs()
         self._generate_static_data()
+        self._build_lookup_tables()
+
+    def _check_engine(self):
+        if self.engine not in ENGINES:
+            raise ValueError(f"Engine {self.engine} not supported, choose one of {ENGINES}")
+        if (self.chunk_size or self.compact) and self.engine != 'numpy':
+            raise ValueError("Chunked and compact generation are only supported by the numpy engine")
+        check_format(self.output_format)
 
     def _set_seed(self):
-        random.seed(self.seed)
-        np.random.seed(self.seed)
+        ## the generator owns its random state, the global random / np.random modules are left alone
+        self.random = random.Random(self.seed)
+        self._day_ends = None
+        self._last_block = (None, None)
     
     def _check_dirs(self):
         os.makedirs(self.output_dir, exist_ok=True)
 
     def _generate_static_data(self):
+        self.ports, self.municipalities, self.commodities, self.state_commodity_weights = load_topology(self.topology_path)
+        logger.info(f"Loaded topology {self.topology_path}: {len(self.municipalities)} municipalities, {len(self.ports)} ports, {len(self.commodities)} commodities")
 
-        self.ports = {
-            'Santos': {'lat': -23.944841, 'lon': -46.330376, 'state': 'SP'},
-            'Paranaguá': {'lat': -25.520000, 'lon': -48.508889, 'state': 'PR'},
-            'Rio Grande': {'lat': -32.034315, 'lon': -52.099266, 'state': 'RS'},
-            'Itaqui': {'lat': -2.592778, 'lon': -44.366667, 'state': 'MA'},
-            'Belém': {'lat': -1.455833, 'lon': -48.504167, 'state': 'PA'},
-            'Itacoatiara': {'lat': -3.143056, 'lon': -58.444167, 'state': 'AM'},
-            'Vitória': {'lat': -20.315556, 'lon': -40.312222, 'state': 'ES'},
-            'Suape': {'lat': -8.421667, 'lon': -35.006667, 'state': 'PE'},
-            'Ilhéus': {'lat': -14.795833, 'lon': -39.045833, 'state': 'BA'},
-            'Navegantes': {'lat': -26.896944, 'lon': -48.632222, 'state': 'SC'}
-        }
-        
-        self.municipalities = {
-            # 10 major agricultural cities
-            'Sorriso': {'lat': -12.544722, 'lon': -55.711389, 'state': 'MT'},
-            'Lucas do Rio Verde': {'lat': -13.050556, 'lon': -55.911111, 'state': 'MT'},
-            'Primavera do Leste': {'lat': -15.559167, 'lon': -54.2975, 'state': 'MT'},
-            'Rondonópolis': {'lat': -16.470833, 'lon': -54.635833, 'state': 'MT'},
-            'Rio Verde': {'lat': -17.798056, 'lon': -50.930556, 'state': 'GO'},
-            'Dourados': {'lat': -22.221111, 'lon': -54.805556, 'state': 'MS'},
-            'São Desidério': {'lat': -12.363056, 'lon': -44.974167, 'state': 'BA'},
-            'Cascavel': {'lat': -24.955556, 'lon': -53.455556, 'state': 'PR'},
-            'Cruz Alta': {'lat': -28.638611, 'lon': -53.606389, 'state': 'RS'},
-            'Balsas': {'lat': -7.532500, 'lon': -46.035556, 'state': 'MA'}
-        }
-        
-        self.commodities = {
-            'Soy': {
-                'density': 0.75,
-                'harvest_seasonality': [2, 3, 4, 5],
-                'base_price': 1800,
-                'price_variation': 0.3
-            },
-            'Corn': {
-                'density': 0.72,
-                'harvest_seasonality': [6, 7, 8, 9],
-                'base_price': 950,
-                'price_variation': 0.25
-            },
-            'Cotton': {
-                'density': 0.32,
-                'harvest_seasonality': [6, 7, 8],
-                'base_price': 8500,
-                'price_variation': 0.4
-            },
-            'Sugar': {
-                'density': 0.8,
-                'harvest_seasonality': [4, 5, 6, 7, 8, 9, 10],
-                'base_price': 2200,
-                'price_variation': 0.35
-            },
-            'Coffee': {
-                'density': 0.65,
-                'harvest_seasonality': [5, 6, 7, 8],
-                'base_price': 12500,
-                'price_variation': 0.5
-            },
-            'Soybean Meal': {
-                'density': 0.6,
-                'harvest_seasonality': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12],
-                'base_price': 2100,
-                'price_variation': 0.3
-            },
-            'Soybean Oil': {
-                'density': 0.92,
-                'harvest_seasonality': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12],
-                'base_price': 4500,
-                'price_variation': 0.4
-            },
-            'Wheat': {
-                'density': 0.78,
-                'harvest_seasonality': [10, 11, 12, 1, 2],
-                'base_price': 1200,
-                'price_variation': 0.3
-            }
-        }
+    def _build_lookup_tables(self):
+        """
+        Array views of the static data, indexed by position, used by the numpy engine
+        """
+        self._municipality_names = np.array(list(self.municipalities.keys()), dtype=object)
+        self._municipality_states = np.array([m['state'] for m in self.municipalities.values()], dtype=object)
+        self._municipality_lat = np.array([m['lat'] for m in self.municipalities.values()])
+        self._municipality_lon = np.array([m['lon'] for m in self.municipalities.values()])
 
-    def _choose_commodity(self, state):
-        if state in ['MT', 'MS', 'GO']:
-            commodity = random.choices(['Soy', 'Corn', 'Cotton', 'Soybean Meal'], weights=[45, 35, 10, 10])[0]
-        elif state in ['BA', 'MA', 'PI', 'TO']:
-            commodity = random.choices(['Soy', 'Corn', 'Cotton'], weights=[50, 30, 20])[0]
-        elif state in ['PR', 'RS']:
-            commodity = random.choices(['Soy', 'Corn', 'Wheat'], weights=[40, 40, 20])[0]
-        elif state == 'SP':
-            commodity = random.choices(['Soy', 'Corn', 'Sugar', 'Coffee'], weights=[30, 30, 25, 15])[0]
-        else:
-            commodity = random.choice(['Soy', 'Corn'])
+        self._port_names = np.array(list(self.ports.keys()), dtype=object)
+        self._port_states = np.array([p['state'] for p in self.ports.values()], dtype=object)
+
+        self._state_names = np.array(sorted(set(self._municipality_states) | set(self._port_states)), dtype=object)
+        state_index = {state: i for i, state in enumerate(self._state_names)}
+        self._municipality_state_idx = np.array([state_index[state] for state in self._municipality_states])
+        self._port_state_idx = np.array([state_index[state] for state in self._port_states])
+        self._port_lat = np.array([p['lat'] for p in self.ports.values()])
+        self._port_lon = np.array([p['lon'] for p in self.ports.values()])
+        port_factors = np.array([self._port_factor_range(port) for port in self._port_names])
+        self._port_factor_low, self._port_factor_high = port_factors[:, 0], port_factors[:, 1]
 
-        return commodity
+        self._commodity_names = np.array(list(self.commodities.keys()), dtype=object)
+        self._commodity_base_price = np.array([c['base_price'] for c in self.commodities.values()], dtype=float)
+        self._commodity_price_variation = np.array([c['price_variation'] for c in self.commodities.values()], dtype=float)
+
+        ## harvest flag per commodity and month (column 0 unused, months are 1-12)
+        self._harvest_table = np.zeros((len(self._commodity_names), 13), dtype=bool)
+        for i, commodity in enumerate(self.commodities.values()):
+            self._harvest_table[i, commodity['harvest_seasonality']] = True
+
+        ## cumulative commodity weights per state, offset by the row number so a single
+        ## searchsorted over the flattened table samples every row at once; the table grows with
+        ## the number of states and commodities, not with the number of municipalities
+        commodity_index = {name: i for i, name in enumerate(self._commodity_names)}
+        weights = np.zeros((len(self._state_names), len(self._commodity_names)))
+        for i, state in enumerate(self._state_names):
+            names, state_weights = self._commodity_weights(state)
+            weights[i, [commodity_index[name] for name in names]] = state_weights
+        cumulative = np.cumsum(weights, axis=1) / weights.sum(axis=1, keepdims=True)
+        self._commodity_cumulative = (cumulative + np.arange(len(self._state_names))[:, None]).ravel()
+
+        ## route geometry and labels, computed once and looked up by route_id
+        self.routes = build_route_table(self.municipalities, self.ports)
+        self._route_labels = self.routes['route'].to_numpy(dtype=object)
+        self._route_distance = self.routes['distance_km'].to_numpy()
+
+        self._build_date_tables(self.range_days + 1)
+
+    def _build_date_tables(self, num_days):
+        ## per day offset from base_date: date, its string, year and month
+        dates = np.datetime64(self.base_date, 'D') + np.arange(num_days)
+        self._dates = dates.astype('datetime64[ns]')
+        self._date_strings = np.datetime_as_string(dates, unit='D').astype(object)
+        self._date_years = dates.astype('datetime64[Y]').astype(np.int64) + 1970
+        self._date_months = dates.astype('datetime64[M]').astype(np.int64) % 12 + 1
+
+    def _commodity_weights(self, state):
+        weights = self.state_commodity_weights.get(state, self.state_commodity_weights['default'])
+        return list(weights.keys()), list(weights.values())
+
+    def _port_factor_range(self, port):
+        return tuple(self.ports[port]['factor_range'])
+
+    def _choose_commodity(self, state):
+        commodities, weights = self._commodity_weights(state)
+        return self.random.choices(commodities, weights=weights)[0]
 
     def generate_origin_data(self):
-        municipality = random.choice(list(self.municipalities.keys()))
+        municipality = self.random.choice(list(self.municipalities.keys()))
         origin_state = self.municipalities.get(municipality).get('state')
         commodity = self._choose_commodity(state=origin_state)
         lat1 = self.municipalities.get(municipality).get('lat')
@@ -128,7 +154,7 @@ class DataGenerator:
         return municipality, origin_state, commodity, lat1, lon1
 
     def generate_port_data(self):
-        port = random.choice(list(self.ports.keys()))
+        port = self.random.choice(list(self.ports.keys()))
         lat2 = self.ports.get(port).get('lat')
         lon2 = self.ports.get(port).get('lon')
 
@@ -138,64 +164,271 @@ class DataGenerator:
         seasonality_mult = 1.0
         seasons = self.commodities.get(commodity).get('harvest_seasonality')
         if operation_month in seasons:
-            seasonality_mult = random.uniform(1.2, 1.8)
+            seasonality_mult = self.random.uniform(1.2, 1.8)
         else:
-            seasonality_mult = random.uniform(0.7, 1.1)
+            seasonality_mult = self.random.uniform(0.7, 1.1)
         
         return seasonality_mult
 
     def generate_tonnage(self, distance, seasonality_mult):
         
         if distance < 500:
-            base_tonnage = random.uniform(25, 35)
+            base_tonnage = self.random.uniform(25, 35)
         elif distance < 1000:
-            base_tonnage = random.uniform(30, 40)
+            base_tonnage = self.random.uniform(30, 40)
         else:
-            base_tonnage = random.uniform(35, 45)
+            base_tonnage = self.random.uniform(35, 45)
 
         return base_tonnage * seasonality_mult
 
     def generate_economic_data(self, port, seasonality_mult, distance, tonnage, commodity):
         
-        base_cost_per_km = random.uniform(0.12, 0.18)
-        fixed_cost = random.uniform(50, 150)
+        base_cost_per_km = self.random.uniform(0.12, 0.18)
+        fixed_cost = self.random.uniform(50, 150)
 
-        fuel_factor = random.uniform(0.9, 1.3)
+        fuel_factor = self.random.uniform(0.9, 1.3)
         seasonality_factor = seasonality_mult * 0.3 + 0.7
-        port_factor = 1.0
-        
-        if port in ['Santos', 'Paranaguá']:
-            port_factor = random.uniform(1.1, 1.3)
-        elif port in ['Rio Grande', 'Itaqui']:
-            port_factor = random.uniform(1.0, 1.2)
-        else:
-            port_factor = random.uniform(0.9, 1.1)
+        port_factor = self.random.uniform(*self._port_factor_range(port))
 
         cost_per_ton = (base_cost_per_km * distance + fixed_cost) * fuel_factor * seasonality_factor * port_factor
-        cost_per_ton *= random.uniform(0.85, 1.15)
+        cost_per_ton *= self.random.uniform(0.85, 1.15)
         
         total_cost = cost_per_ton * tonnage
-        price_var = random.uniform(1 - self.commodities.get(commodity).get('price_variation'), 1 + self.commodities.get(commodity).get('price_variation')) 
+        price_var = self.random.uniform(1 - self.commodities.get(commodity).get('price_variation'), 1 + self.commodities.get(commodity).get('price_variation')) 
         commodity_price = self.commodities.get(commodity).get('base_price') * price_var
 
         return total_cost, commodity_price, cost_per_ton
 
     def generate(self):
 
+        logger.info(f"Generating {self.num_operations} operations with the {self.engine} engine")
+        if self.engine == 'numpy':
+            df = self.generate_rows(0, self.num_operations)
+        else:
+            df = self._generate_rows()
+
+        self._write_chunks([df], self.output_path)
+    
+        return df
+
+    def generate_streaming(self):
+        """
+        Generate the data in chunks of chunk_size rows, appending each one to the output file,
+        so peak memory depends on the chunk size and not on num_operations
+        """
+        chunk_size = self.chunk_size or self.num_operations
+
+        logger.info(f"Generating {self.num_operations} operations in chunks of {chunk_size}")
+        self._write_chunks(self.iter_chunks(chunk_size), self.output_path)
+
+        return self.output_path
+
+    def generate_shard(self, shard_index, shard_count):
+        """
+        Generate the shard_index-th of shard_count contiguous slices of the rows into its own part
+        file. Rows are drawn from per block streams, so the parts concatenated (or merged) are
+        exactly the output of a single unsharded run.
+        """
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(f"Shard index {shard_index} out of range for {shard_count} shards")
+
+        size, remainder = divmod(self.num_operations, shard_count)
+        start = shard_index * size + min(shard_index, remainder)
+        stop = start + size + (shard_index < remainder)
+        output_path = self.part_path(shard_index, shard_count)
+
+        logger.info(f"Generating shard {shard_index + 1}/{shard_count} with {stop - start} operations")
+        self._write_chunks(self.iter_chunks(self.chunk_size or (stop - start) or 1, start=start, stop=stop), output_path)
+
+        return output_path
+
+    def generate_incremental(self, until=None):
+        """
+        Append to the dataset on disk the operations of the days after its last operation_date,
+        up to until (today by default), with the same expected volume per day and distributions
+        as a full run. The full history is generated first when there is no dataset yet.
+        """
+        if not os.path.exists(self.output_path):
+            logger.info(f"No dataset at {self.output_path}, generating the full history first")
+            self.generate_streaming() if self.chunk_size else self.generate()
+
+        base_date = np.datetime64(self.base_date, 'D')
+        first_offset = int((np.datetime64(last_value(self.output_path, 'operation_date'), 'D') - base_date).astype(int)) + 1
+        last_offset = int((np.datetime64(until or date.today(), 'D') - base_date).astype(int))
+        if last_offset < first_offset:
+            logger.info(f"Dataset {self.output_path} is already up to date")
+            return 0
+
+        ## the streams depend only on the seed and the first new day, so a rerun appends the same rows
+        self._build_date_tables(last_offset + 1)
+        self._last_block = (None, None)
+        key = (STREAM_INCREMENTAL, first_offset)
+        day_counts = self._stream(*key).binomial(self.num_operations, 1 / (self.range_days + 1), size=last_offset - first_offset + 1)
+        day_ends = np.cumsum(day_counts)
+        num_rows = int(day_ends[-1])
+
+        logger.info(f"Appending {num_rows} operations for {len(day_counts)} new days to {self.output_path}")
+        chunk_size = self.chunk_size or max(num_rows, 1)
+        prefix = f"part-{self._date_strings[first_offset].replace('-', '')}"
+        with DatasetWriter(self.output_path, self.output_format, self.compression, append=True, prefix=prefix) as writer:
+            for start in range(0, num_rows, chunk_size):
+                writer.write(self._rows(day_ends, first_offset, key, start, min(start + chunk_size, num_rows)))
+
+        return writer.num_rows
+
+    def part_path(self, shard_index, shard_count):
+        return part_path(self.output_path, shard_index, shard_count)
+
+    def _write_chunks(self, chunks, output_path):
+        with DatasetWriter(output_path, self.output_format, self.compression) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+
+        return writer.num_rows
+
+    def iter_chunks(self, chunk_size, start=0, stop=None):
+        """
+        Yield rows start..stop-1 (all rows by default) as DataFrames of at most chunk_size rows,
+        ordered by operation_date. The chunks are the same rows as a single generate() call
+        whatever the chunk size.
+        """
+        stop = self.num_operations if stop is None else stop
+
+        ## always yield at least one (possibly empty) chunk so the output file gets a header
+        for chunk_start in range(start, max(stop, start + 1), chunk_size):
+            yield self.generate_rows(chunk_start, min(chunk_start + chunk_size, stop))
+
+    def generate_rows(self, start, stop):
+        """
+        Rows start..stop-1 of the dataset, ordered by operation_date. The number of operations per
+        day is drawn once up front (the multinomial equivalent of sorting uniform day offsets) and
+        every block of BLOCK_SIZE rows draws from streams derived from the seed and the block index
+        only, so any range of rows is regenerated deterministically on its own, independently of
+        chunking, sharding or other generators in the process.
+        """
+        if self._day_ends is None:
+            num_days = self.range_days + 1
+            day_counts = self._stream(STREAM_DAYS).multinomial(self.num_operations, np.full(num_days, 1 / num_days))
+            self._day_ends = np.cumsum(day_counts)
+
+        return self._rows(self._day_ends, 0, (STREAM_ROWS,), start, stop)
+
+    def _rows(self, day_ends, first_day, key, start, stop):
+        ## rows start..stop-1 of the rows laid out over the days by day_ends, cut from whole blocks
+        frames = []
+        for block in range(start // BLOCK_SIZE, -(-stop // BLOCK_SIZE)):
+            block_start = block * BLOCK_SIZE
+            frames.append(self._block(day_ends, first_day, key, block).iloc[max(start - block_start, 0):stop - block_start])
+
+        if not frames:
+            return self.generate_batch(np.zeros(0, dtype=np.int64), self._streams(*key, 0))
+        return frames[0].reset_index(drop=True) if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+    def _block(self, day_ends, first_day, key, block):
+        ## the last block is kept, consecutive chunks smaller than a block reuse it
+        if self._last_block[0] != key + (block,):
+            block_start = block * BLOCK_SIZE
+            rows = np.arange(block_start, min(block_start + BLOCK_SIZE, day_ends[-1]))
+            day_offsets = first_day + np.searchsorted(day_ends, rows, side='right')
+            self._last_block = (key + (block,), self.generate_batch(day_offsets, self._streams(*key, block)))
+        return self._last_block[1]
+
+    def _stream(self, *key):
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=key))
+
+    def _streams(self, *key):
+        ## one independent generator per field, so a field's draws do not depend on the others
+        children = np.random.SeedSequence(self.seed, spawn_key=key).spawn(len(STREAM_FIELDS))
+        return dict(zip(STREAM_FIELDS, map(np.random.default_rng, children)))
+
+    def generate_batch(self, day_offsets, streams):
+        """
+        Generate one operation per entry of day_offsets (days after base_date), sampling every
+        field as a whole array with the same distributions as the row by row engine. streams maps
+        each of STREAM_FIELDS to the numpy Generator it is drawn from.
+        """
+        n = len(day_offsets)
+
+        ## origin, commodity and destination
+        municipality_idx = streams['municipality'].integers(0, len(self._municipality_names), size=n)
+        state_idx = self._municipality_state_idx[municipality_idx]
+        commodity_draw = state_idx + streams['commodity'].random(n)
+        commodity_idx = np.searchsorted(self._commodity_cumulative, commodity_draw, side='right') - state_idx * len(self._commodity_names)
+        port_idx = streams['port'].integers(0, len(self._port_names), size=n)
+        route_idx = municipality_idx * len(self._port_names) + port_idx
+
+        lat1, lon1 = self._municipality_lat[municipality_idx], self._municipality_lon[municipality_idx]
+        lat2, lon2 = self._port_lat[port_idx], self._port_lon[port_idx]
+        distance_km = self._route_distance[route_idx]
+
+        ## date
+        operation_month = self._date_months[day_offsets]
+
+        ## seasonality multiplier
+        in_season = self._harvest_table[commodity_idx, operation_month]
+        season_mult = np.where(in_season, 1.2, 0.7) + np.where(in_season, 0.6, 0.4) * streams['season'].random(n)
+
+        ## tonnage
+        base_tonnage = np.select([distance_km < 500, distance_km < 1000], [25.0, 30.0], 35.0) + 10 * streams['tonnage'].random(n)
+        tonnage = base_tonnage * season_mult
+
+        ## economic data
+        base_cost_per_km = streams['base_cost'].uniform(0.12, 0.18, size=n)
+        fixed_cost = streams['fixed_cost'].uniform(50, 150, size=n)
+        fuel_factor = streams['fuel_factor'].uniform(0.9, 1.3, size=n)
+        seasonality_factor = season_mult * 0.3 + 0.7
+        port_factor = streams['port_factor'].uniform(self._port_factor_low[port_idx], self._port_factor_high[port_idx])
+
+        cost_per_ton = (base_cost_per_km * distance_km + fixed_cost) * fuel_factor * seasonality_factor * port_factor
+        cost_per_ton *= streams['cost_noise'].uniform(0.85, 1.15, size=n)
+        total_cost = cost_per_ton * tonnage
+        price_variation = self._commodity_price_variation[commodity_idx]
+        commodity_price = self._commodity_base_price[commodity_idx] * streams['price'].uniform(1 - price_variation, 1 + price_variation)
+
+        df = pd.DataFrame({
+            'operation_date': self._dates[day_offsets] if self.compact else self._date_strings[day_offsets],
+            'origin_municipality': self._labels(self._municipality_names, municipality_idx),
+            'origin_state': self._labels(self._state_names, state_idx),
+            'origin_lat': lat1,
+            'origin_lon': lon1,
+            'destination_port': self._labels(self._port_names, port_idx),
+            'destination_state': self._labels(self._state_names, self._port_state_idx[port_idx]),
+            'destination_lat': lat2,
+            'destination_lon': lon2,
+            'commodity': self._labels(self._commodity_names, commodity_idx),
+            'tonnage': np.round(tonnage, 2),
+            'distance_km': np.round(distance_km, 0),
+            'total_freight_value': np.round(total_cost, 2),
+            'value_per_ton': np.round(cost_per_ton, 2),
+            'commodity_reference_price': np.round(commodity_price, 2),
+            'month': operation_month,
+            'year': self._date_years[day_offsets],
+            'route': self._labels(self._route_labels, route_idx)
+        })
+
+        return compact_frame(df) if self.compact else df
+
+    def _labels(self, names, codes):
+        ## in compact mode the codes are used as they are, no string array is built
+        if self.compact:
+            return pd.Categorical.from_codes(codes, categories=names)
+        return names[codes]
+
+    def _generate_rows(self):
+
         data = []
 
-        logger.info(f"Generating {self.num_operations} operations")
         for i in range(self.num_operations):
             municipality, origin_state, commodity, lat1, lon1 = self.generate_origin_data()
             port, lat2, lon2 = self.generate_port_data()
 
             ## calculate distance
-            distance_km = np.sqrt((lat2-lat1)**2 + (lon2-lon1)**2) * 111
+            distance_km = haversine_km(lat1, lon1, lat2, lon2)
 
             ## date
             fmt = "%Y-%m-%d"
             base_date = datetime.strptime(self.base_date, fmt)
-            operation_date = base_date + timedelta(days=random.randint(0, self.range_days))
+            operation_date = base_date + timedelta(days=self.random.randint(0, self.range_days))
             operation_month = operation_date.month
 
             ## seasonality multiplier
@@ -234,7 +467,216 @@ class DataGenerator:
         ## final df
         df = pd.DataFrame(data)
         df = df.sort_values('operation_date').reset_index(drop=True)    
-        output_path = os.path.join(self.output_dir, self.file_name)
-        df.to_csv(output_path, index=False)
     
-        return df
\ No newline at end of file
+        return df
+
+
+def load_topology(path):
+    """
+    Read the generator topology from a json file: ports and municipalities (lists of records, or
+    the path of a csv with name, lat, lon, state[, factor_low, factor_high] columns relative to the
+    json), commodities and the commodity weights per state, with a 'default' entry for the states
+    not listed. Returns the ports, municipalities and commodities as dicts keyed by name, and the
+    weights per state.
+    """
+    with open(path, encoding='utf-8') as f:
+        topology = json.load(f)
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    ports = _topology_records(topology['ports'], base_dir)
+    municipalities = _topology_records(topology['municipalities'], base_dir)
+    commodities = _topology_records(topology['commodities'], base_dir)
+    weights = topology['state_commodity_weights']
+
+    for port in ports.values():
+        if 'factor_low' in port:
+            port['factor_range'] = [port.pop('factor_low'), port.pop('factor_high')]
+        port.setdefault('factor_range', [0.9, 1.1])
+
+    if 'default' not in weights:
+        raise ValueError(f"Topology {path} has no 'default' commodity weights")
+    unknown = {name for state_weights in weights.values() for name in state_weights} - set(commodities)
+    if unknown:
+        raise ValueError(f"Topology {path} weights unknown commodities {sorted(unknown)}")
+    if not municipalities or not ports:
+        raise ValueError(f"Topology {path} needs at least one municipality and one port")
+
+    return ports, municipalities, commodities, weights
+
+
+def _topology_records(records, base_dir):
+    ## large tables can live in a csv next to the json instead of inline records
+    if isinstance(records, str):
+        records = pd.read_csv(os.path.join(base_dir, records)).to_dict('records')
+    return {record.pop('name'): record for record in map(dict, records)}
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in km between points given in degrees, for scalars or arrays
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def build_route_table(municipalities: dict, ports: dict) -> pd.DataFrame:
+    """
+    One row per origin municipality x destination port, indexed by route_id
+    (municipality position * number of ports + port position), with the states, coordinates,
+    great-circle distance and route label. The compact schema uses the same order for the
+    route categories, so there the route codes are the route ids.
+    """
+    municipality_idx, port_idx = np.divmod(np.arange(len(municipalities) * len(ports)), len(ports))
+    origins = pd.DataFrame.from_dict(municipalities, orient='index').iloc[municipality_idx]
+    destinations = pd.DataFrame.from_dict(ports, orient='index').iloc[port_idx]
+
+    routes = pd.DataFrame({
+        'origin_municipality': origins.index.to_numpy(dtype=object),
+        'origin_state': origins['state'].to_numpy(dtype=object),
+        'origin_lat': origins['lat'].to_numpy(dtype=float),
+        'origin_lon': origins['lon'].to_numpy(dtype=float),
+        'destination_port': destinations.index.to_numpy(dtype=object),
+        'destination_state': destinations['state'].to_numpy(dtype=object),
+        'destination_lat': destinations['lat'].to_numpy(dtype=float),
+        'destination_lon': destinations['lon'].to_numpy(dtype=float),
+    })
+    routes['distance_km'] = haversine_km(routes['origin_lat'], routes['origin_lon'], routes['destination_lat'], routes['destination_lon'])
+    routes['route'] = (
+        routes['origin_municipality'] + '_' + routes['origin_state'] + '->'
+        + routes['destination_port'] + '_' + routes['destination_state']
+    )
+    routes.index.name = 'route_id'
+
+    return routes
+
+
+def part_path(output_path, shard_index, shard_count):
+    stem, ext = os.path.splitext(output_path)
+    return f"{stem}.part-{shard_index:05d}-of-{shard_count:05d}{ext}"
+
+
+def finalize_parts(output_dir, file_name, shard_count, chunk_size=1_000_000, output_format='csv', compression='zstd',
+                   wait_seconds=0, poll_seconds=10):
+    """
+    Merge the part files of a sharded run into the final dataset once every part is on disk.
+    Every worker calls it when it finishes, so the last one to finish does the merge; a lock
+    file keeps two workers from merging at the same time. Returns None when nothing was merged.
+
+    With wait_seconds (the last completion index of an Indexed Job), the worker waits that long for
+    the parts still missing, or for another worker to merge them, and raises when they never show
+    up, e.g. when the workers do not share the volume of the parts, so that the run fails instead of
+    succeeding without a dataset.
+    """
+    output_path = dataset_path(output_dir, file_name, output_format)
+    part_paths = [part_path(output_path, i, shard_count) for i in range(shard_count)]
+    lock_path = f"{output_path}.lock"
+    deadline = time.monotonic() + wait_seconds
+
+    while True:
+        if all(os.path.exists(path) for path in part_paths):
+            if _merge_parts(part_paths, output_path, lock_path, chunk_size, output_format, compression):
+                return output_path
+        ## the parts, ours included, are only removed by the worker that merged them
+        elif not any(os.path.exists(path) for path in part_paths) and not os.path.exists(lock_path):
+            logger.info(f"Parts of {file_name} already merged by another worker")
+            return None
+
+        if not wait_seconds:
+            logger.info(f"Parts of {file_name} still missing or being merged, leaving the merge to another worker")
+            return None
+        if time.monotonic() > deadline:
+            missing = [path for path in part_paths if not os.path.exists(path)]
+            if not missing:
+                raise RuntimeError(f"Parts of {file_name} still locked by {lock_path} after {wait_seconds}s, remove it if no worker is merging")
+            raise RuntimeError(f"{len(missing)} of {shard_count} parts of {file_name} still missing after {wait_seconds}s, "
+                               f"e.g. {missing[:3]}: every worker must write its part to the same shared volume")
+        time.sleep(poll_seconds)
+
+
+def _merge_parts(part_paths, output_path, lock_path, chunk_size, output_format, compression):
+    ## merge under the lock, False when another worker holds it or merged the parts first
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        logger.info(f"Parts of {output_path} are already being merged by another worker")
+        return False
+
+    try:
+        ## another worker may have merged and removed the parts before we got the lock
+        if not all(os.path.exists(path) for path in part_paths):
+            return False
+        merge_sorted_parts(part_paths, output_path, chunk_size=chunk_size, output_format=output_format, compression=compression)
+        for path in part_paths:
+            remove_dataset(path)
+    finally:
+        os.remove(lock_path)
+
+    return True
+
+
+def merge_sorted_parts(part_paths, output_path, sort_column='operation_date', chunk_size=1_000_000,
+                       output_format='csv', compression='zstd'):
+    """
+    K-way merge of part files already sorted by sort_column into output_path. Parts are read in
+    blocks so memory is bounded by chunk_size, and rows with the same key are written in the order
+    of part_paths, making the result independent of the block size.
+    """
+    if not part_paths:
+        raise ValueError("No part files to merge")
+
+    block_size = max(chunk_size // len(part_paths), 1)
+    readers = [_sort_key_blocks(read_chunks(path, block_size), sort_column) for path in part_paths]
+    buffers = [next(reader, None) for reader in readers]
+    exhausted = [buffer is None for buffer in buffers]
+    buffers = [pd.DataFrame() if buffer is None else buffer for buffer in buffers]
+
+    writer = DatasetWriter(output_path, output_format, compression)
+    while True:
+        ## rows below the smallest last key of the readers still open can be emitted safely
+        ## parts with only a header (fewer rows than shards) yield empty blocks and count as exhausted
+        exhausted = [done or buffer.empty for buffer, done in zip(buffers, exhausted)]
+        last_keys = [buffer[sort_column].iloc[-1] for buffer, done in zip(buffers, exhausted) if not done]
+        bound = min(last_keys) if last_keys else None
+
+        emitted = []
+        for i, buffer in enumerate(buffers):
+            if buffer.empty:
+                continue
+            split = len(buffer) if bound is None else buffer[sort_column].searchsorted(bound, side='left')
+            emitted.append(buffer.iloc[:split])
+            buffers[i] = buffer.iloc[split:]
+
+        emitted = [frame for frame in emitted if not frame.empty]
+        if emitted:
+            writer.write(pd.concat(emitted).sort_values(sort_column, kind='stable'))
+
+        if bound is None:
+            break
+
+        ## refill the readers holding the bound back
+        for i, (buffer, done) in enumerate(zip(buffers, exhausted)):
+            if done or buffer[sort_column].iloc[-1] != bound:
+                continue
+            block = next(readers[i], None)
+            if block is None:
+                exhausted[i] = True
+            else:
+                buffers[i] = pd.concat([buffer, block])
+
+    if writer.num_chunks == 0:
+        writer.write(pd.read_csv(part_paths[0], nrows=0) if output_format == 'csv' else pd.DataFrame())
+    writer.close()
+    logger.info(f"Merged {len(part_paths)} parts into {output_path}")
+
+    return output_path
+
+
+def _sort_key_blocks(blocks, sort_column):
+    ## columnar parts come back with dictionary encoded (categorical) strings, compare raw values
+    for block in blocks:
+        if block.empty:
+            continue
+        if isinstance(block[sort_column].dtype, pd.CategoricalDtype):
+            block[sort_column] = block[sort_column].astype(object)
+        yield block
\ No newline at end of file
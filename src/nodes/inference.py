@@ -0,0 +1,117 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from loguru import logger
+from src.nodes.model_registry import GLOBAL_ID, ModelRegistry
+from src.nodes.preprocessing import FeatureEngineer, RouteAggregator, RoutePanel, generate_seasonality_features
+from src.nodes.storage import to_arrow_table
+from src.nodes.training import ID_COLUMN, PREDICTION_COLUMN, SEASONALITY_FEATURES, TIME_COLUMN, panel_series, recursive_forecast
+
+HORIZONS = (30, 60, 90, 180)
+MODES = ('per_route', 'global')
+
+
+def route_curves(df: pd.DataFrame, registry: ModelRegistry, horizons: tuple = HORIZONS, mode: str = 'per_route',
+                 cutoff_date: str = None, target_column: str = 'value_per_ton', group_columns: tuple = ('route', 'commodity'),
+                 date_column: str = 'operation_date', lags: tuple = (7, 14, 30), rolling_windows: tuple = (7, 14, 30),
+                 momentum: tuple = ((7, 30),)) -> pd.DataFrame:
+    """
+    Forecast curves of every route series of df for the max(horizons) days after cutoff_date (the
+    last day of df by default), from the models of the registry: the best model of each series in
+    per_route mode, the global model in global mode. lags / rolling_windows / momentum are those the
+    per route models were trained with.
+
+    One long frame with a row per series and day ahead (step), tagged with the shortest horizon
+    covering it, so each horizon's curve is the rows with horizon <= it. Every series is forecast at
+    once: the daily series come from a single RoutePanel, the global model runs a single recursive
+    predict, and per route models forecast day by day with the features of every series computed as
+    arrays (see training.recursive_forecast, the forecast the per route models are validated with).
+    """
+    if mode not in MODES:
+        raise ValueError(f"Mode {mode} not supported, choose one of {MODES}")
+    horizons = tuple(sorted(horizons))
+    start = time.perf_counter()
+
+    panel = RouteAggregator(date_column, tuple(group_columns), value_columns=(target_column,), end_date=cutoff_date).transform(df)
+    if mode == 'global':
+        forecasts, models = _global_forecasts(panel, registry, target_column, horizons[-1])
+    else:
+        forecasts, models = _route_forecasts(panel, registry, target_column, horizons[-1], lags, rolling_windows, momentum)
+    curves = _curves(panel, forecasts, models, horizons)
+
+    logger.info(f"Forecast {panel.shape[0]} series x {horizons[-1]} days ({mode}) in {time.perf_counter() - start:.2f}s")
+    return curves
+
+
+def write_curves(curves: pd.DataFrame, output_dir: str, compression: str = 'zstd') -> str:
+    """
+    Write every curve to a single parquet file named after their cutoff date
+    """
+    cutoff = pd.Timestamp(curves['cutoff'].iloc[0]) if len(curves) else pd.Timestamp.now()
+    path = os.path.join(output_dir, f"curves_{cutoff:%Y-%m-%d}.parquet")
+    os.makedirs(output_dir, exist_ok=True)
+    pq.write_table(to_arrow_table(curves), f"{path}.tmp", compression=compression)
+    os.replace(f"{path}.tmp", path)
+    logger.info(f"Wrote {len(curves)} forecasts to {path}")
+    return path
+
+
+def _global_forecasts(panel: RoutePanel, registry: ModelRegistry, target_column: str, max_horizon: int):
+    ## one recursive predict of the global model from the history of every series
+    forecaster = registry.load(GLOBAL_ID)
+    forecasts = forecaster.predict(max_horizon, panel_series(panel, target_column))
+
+    values = np.full((panel.shape[0], max_horizon), np.nan)
+    rows = panel.series_ids.get_indexer(forecasts[ID_COLUMN].astype(str))
+    steps = (forecasts[TIME_COLUMN].to_numpy() - panel.dates[-1].to_datetime64()) // np.timedelta64(1, 'D') - 1
+    values[rows, steps] = forecasts[PREDICTION_COLUMN].to_numpy()
+    return values, np.full(panel.shape[0], forecaster.model, dtype=object)
+
+
+def _route_forecasts(panel: RoutePanel, registry: ModelRegistry, target_column: str, max_horizon: int, lags: tuple,
+                     rolling_windows: tuple, momentum: tuple):
+    series_ids = panel.series_ids
+    missing = [series_id for series_id in series_ids if series_id not in registry]
+    if missing:
+        logger.warning(f"No model registered for {len(missing)} series, e.g. {missing[:3]}, their curves are empty")
+    models = [registry.load(series_id) if series_id in registry else None for series_id in series_ids]
+    model_names = np.array([registry.best(series_id)['model'] if series_id in registry else None for series_id in series_ids], dtype=object)
+
+    ## the history the first forecast depends on, the forecasts are appended to it day by day
+    history = panel.mean(target_column, fill='ffill')[:, -FeatureEngineer(lags, rolling_windows, momentum).history_days:]
+    forecasts = recursive_forecast(models, history, _future_seasonality(panel, max_horizon), lags, rolling_windows, momentum)
+    return forecasts, model_names
+
+
+def _future_seasonality(panel: RoutePanel, max_horizon: int) -> np.ndarray:
+    ## seasonality features of every series for every day ahead: series x step x feature
+    num_series = panel.shape[0]
+    dates = panel.dates[-1] + pd.to_timedelta(np.arange(1, max_horizon + 1), unit='D')
+    commodity = panel.keys['commodity'].to_numpy() if 'commodity' in panel.keys.columns else np.full(num_series, None)
+    frame = pd.DataFrame({'commodity': np.repeat(commodity, max_horizon), TIME_COLUMN: np.tile(dates.to_numpy(), num_series)})
+    features = generate_seasonality_features(frame, date_column=TIME_COLUMN)[SEASONALITY_FEATURES]
+    return features.to_numpy(dtype=np.float64).reshape(num_series, max_horizon, len(SEASONALITY_FEATURES))
+
+
+def _curves(panel: RoutePanel, forecasts: np.ndarray, models: np.ndarray, horizons: tuple) -> pd.DataFrame:
+    ## long frame of the forecasts, built from repeated / tiled arrays rather than per series frames
+    num_series, max_horizon = forecasts.shape
+    steps = np.arange(1, max_horizon + 1)
+    cutoff = panel.dates[-1].to_datetime64()
+    series = np.repeat(np.arange(num_series), max_horizon)
+
+    curves = {ID_COLUMN: pd.Categorical.from_codes(series, categories=panel.series_ids)}
+    for column in panel.keys.columns:
+        key_codes, key_values = pd.factorize(panel.keys[column], sort=True)
+        curves[column] = pd.Categorical.from_codes(key_codes[series], categories=key_values)
+    curves.update({
+        'cutoff': np.full(len(series), cutoff),
+        TIME_COLUMN: np.tile(cutoff + steps.astype('timedelta64[D]'), num_series),
+        'step': np.tile(steps, num_series),
+        'horizon': np.tile(np.asarray(horizons)[np.searchsorted(horizons, steps)], num_series),
+        'model': pd.Categorical(np.repeat(models, max_horizon)),
+        PREDICTION_COLUMN: forecasts.ravel()
+    })
+    return pd.DataFrame(curves)
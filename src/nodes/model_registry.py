@@ -0,0 +1,245 @@
+import hashlib
+import json
+import math
+import os
+import sys
+from collections import OrderedDict
+from datetime import datetime, timezone
+import joblib
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+MANIFEST_FILE = 'manifest.json'
+## series id of the models fitted on every route at once
+GLOBAL_ID = '__global__'
+## deserialized models kept in memory, well inside the 2Gi of the pods
+DEFAULT_CACHE_BYTES = 512 * 2 ** 20
+## model files above this size have their arrays memory mapped when loaded, smaller ones are read
+## in full: a memory mapped array holds a file descriptor, hundreds of them for a tree ensemble
+MMAP_MIN_BYTES = 64 * 2 ** 20
+
+
+class ModelCache:
+    """
+    Least recently used cache of deserialized models bounded by their total size in bytes: adding a
+    model evicts the least recently used ones until the total fits in max_bytes again
+    """
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._models = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def __contains__(self, key) -> bool:
+        return key in self._models
+
+    def get(self, key):
+        if key not in self._models:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._models.move_to_end(key)
+        return self._models[key][0]
+
+    def put(self, key, model, nbytes: int):
+        if key in self._models:
+            self.nbytes -= self._models.pop(key)[1]
+        self._models[key] = (model, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes and len(self._models) > 1:
+            evicted, (_, evicted_bytes) = self._models.popitem(last=False)
+            self.nbytes -= evicted_bytes
+            logger.debug(f"Evicted model {evicted} from the cache, {self.nbytes} bytes cached")
+
+    def clear(self):
+        self._models.clear()
+        self.nbytes = 0
+
+
+class ModelRegistry:
+    """
+    Versioned models on disk, one joblib file per model version, described by a json manifest
+    (series id, model name, version, metrics, params, file) indexed in memory by series and model
+    on open, so that a series' latest or best model (lowest metric among the latest version of each
+    of its models) is a dictionary lookup and never a directory scan.
+
+    Models are only read from disk when loaded, with their arrays memory mapped (copy on write) for
+    files above mmap_min_bytes, and kept in a ModelCache of cache_bytes sized by their footprint in
+    memory, so loading the same models again on every inference run over all routes hits memory
+    instead of disk.
+    """
+    def __init__(self, registry_dir: str, cache_bytes: int = DEFAULT_CACHE_BYTES, metric: str = 'mae',
+                 mmap_min_bytes: int = MMAP_MIN_BYTES):
+        self.registry_dir = registry_dir
+        self.metric = metric
+        self.mmap_min_bytes = mmap_min_bytes
+        self.cache = ModelCache(cache_bytes)
+        os.makedirs(self.registry_dir, exist_ok=True)
+
+        manifest_path = os.path.join(self.registry_dir, MANIFEST_FILE)
+        entries = []
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                entries = json.load(f)['models']
+        self._versions = {}
+        self._model_names = {}
+        self._best = {}
+        self._add(entries)
+
+    def __len__(self) -> int:
+        return sum(len(versions) for versions in self._versions.values())
+
+    def __contains__(self, unique_id: str) -> bool:
+        return unique_id in self._best
+
+    def register(self, unique_id: str, model_name: str, model, metrics: dict = None, params: dict = None) -> dict:
+        """
+        Save model as the next version of model_name for series unique_id
+        """
+        return self.register_many([(unique_id, model_name, model, metrics, params)])[0]
+
+    def register_many(self, records) -> list:
+        """
+        Save every (unique_id, model_name, model, metrics, params) record, writing the manifest once
+        """
+        created_at = datetime.now(timezone.utc).isoformat()
+        entries = []
+        for unique_id, model_name, model, metrics, params in records:
+            versions = self._versions.get((unique_id, model_name), [])
+            version = versions[-1]['version'] + 1 if versions else 1
+            path = os.path.join(_series_dir(unique_id), model_name, f"v{version}.joblib")
+            os.makedirs(os.path.join(self.registry_dir, os.path.dirname(path)), exist_ok=True)
+            ## uncompressed, so that the arrays of large models can be memory mapped when loading
+            joblib.dump(model, os.path.join(self.registry_dir, path))
+            entry = {
+                'unique_id': unique_id,
+                'model': model_name,
+                'version': version,
+                'path': path,
+                'nbytes': os.path.getsize(os.path.join(self.registry_dir, path)),
+                'metrics': {name: _json_float(value) for name, value in (metrics or {}).items()},
+                'params': params or {},
+                'created_at': created_at
+            }
+            entries.append(entry)
+            self._add([entry])
+
+        self._save()
+        logger.info(f"Registered {len(entries)} models in {self.registry_dir}")
+        return entries
+
+    def entry(self, unique_id: str, model_name: str = None, version: int = None) -> dict:
+        """
+        Manifest entry of a model version: the best model of the series when model_name is None,
+        the latest version when version is None
+        """
+        if model_name is None:
+            if unique_id not in self._best:
+                raise ValueError(f"No model registered for series {unique_id}")
+            return self._best[unique_id]
+
+        versions = self._versions.get((unique_id, model_name))
+        if not versions:
+            raise ValueError(f"No {model_name} model registered for series {unique_id}")
+        if version is None:
+            return versions[-1]
+        for entry in versions:
+            if entry['version'] == version:
+                return entry
+        raise ValueError(f"Version {version} of the {model_name} model of series {unique_id} not found")
+
+    def best(self, unique_id: str) -> dict:
+        return self.entry(unique_id)
+
+    def load(self, unique_id: str, model_name: str = None, version: int = None):
+        """
+        Model of entry(unique_id, model_name, version), from the cache or else from disk
+        """
+        entry = self.entry(unique_id, model_name, version)
+        key = (entry['unique_id'], entry['model'], entry['version'])
+        model = self.cache.get(key)
+        if model is None:
+            mmap_mode = 'c' if entry['nbytes'] >= self.mmap_min_bytes else None
+            model = joblib.load(os.path.join(self.registry_dir, entry['path']), mmap_mode=mmap_mode)
+            self.cache.put(key, model, _model_nbytes(model))
+        return model
+
+    def entries(self) -> pd.DataFrame:
+        """
+        Every registered version, one row each with its metrics as columns, to compare models
+        """
+        rows = [
+            {key: value for key, value in entry.items() if key not in ('metrics', 'params')} | entry['metrics']
+            for versions in self._versions.values() for entry in versions
+        ]
+        return pd.DataFrame(rows)
+
+    def _add(self, entries: list):
+        ## index the entries by series and model, keeping the best entry of every series they touch
+        touched = set()
+        for entry in entries:
+            versions = self._versions.setdefault((entry['unique_id'], entry['model']), [])
+            versions.append(entry)
+            versions.sort(key=lambda version: version['version'])
+            self._model_names.setdefault(entry['unique_id'], set()).add(entry['model'])
+            touched.add(entry['unique_id'])
+        for unique_id in touched:
+            latest = [self._versions[(unique_id, model_name)][-1] for model_name in self._model_names[unique_id]]
+            self._best[unique_id] = min(latest, key=self._rank)
+
+    def _rank(self, entry: dict):
+        ## lowest metric first, entries without it last, then the most recent
+        value = entry['metrics'].get(self.metric)
+        return (value is None, value if value is not None else 0.0, -entry['version'], entry['created_at'])
+
+    def _save(self):
+        manifest_path = os.path.join(self.registry_dir, MANIFEST_FILE)
+        entries = [entry for versions in self._versions.values() for entry in versions]
+        with open(f"{manifest_path}.tmp", 'w') as f:
+            json.dump({'models': entries}, f, indent=1, default=str)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def _model_nbytes(model) -> int:
+    """
+    Memory footprint of a deserialized model: the buffers of its arrays plus the size of every other
+    object reachable from it, each counted once
+    """
+    seen = set()
+    stack = [model]
+    nbytes = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        ## an array counts its buffer when it owns it, a view counts the object owning its buffer
+        nbytes += sys.getsizeof(obj, 0)
+        if isinstance(obj, np.ndarray):
+            if obj.base is not None:
+                stack.append(obj.base)
+            if obj.dtype.hasobject:
+                stack.extend(obj.ravel())
+        elif isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__') and not isinstance(obj, type):
+            stack.append(obj.__dict__)
+    return nbytes
+
+
+def _series_dir(unique_id: str) -> str:
+    ## series ids hold separators and accents, their hash makes a safe directory name
+    return hashlib.sha1(unique_id.encode()).hexdigest()[:16]
+
+
+def _json_float(value):
+    value = float(value)
+    return None if math.isnan(value) else value
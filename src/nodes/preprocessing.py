@@ -1,30 +1,44 @@
+import operator
+import os
+import re
+import numpy as np
 import pandas as pd
+from functools import lru_cache
 from typing import Tuple
 from sklearn.base import BaseEstimator, TransformerMixin
 from loguru import logger
+from mlforecast import MLForecast
+from mlforecast.lag_transforms import Combine, RollingMax, RollingMean, RollingMin, RollingStd
+from src.nodes.datagen import TOPOLOGY_PATH, load_topology
+from src.nodes.schema import parse_dates
+from src.nodes.storage import read_dataset, read_date_range
 
 
 class DateFilter(BaseEstimator, TransformerMixin):
-    def __init__(self, date_column: str, date_str_format: str = '%Y-%m-%d', start_date: str = None, end_date: str = None):
+    """
+    Keep the rows with date_column between start_date and end_date (both included).
+    When the dates are sorted (assume_sorted=True, or detected when None) the window is found by
+    binary search and returned as a positional slice of X, without scanning or copying the data;
+    unsorted dates fall back to a vectorized mask.
+    """
+    def __init__(self, date_column: str, date_str_format: str = '%Y-%m-%d', start_date: str = None, end_date: str = None,
+                 assume_sorted: bool = None):
     
         self.date_column = date_column
         self.date_str_format = date_str_format
         self.start_date = start_date
         self.end_date = end_date
+        self.assume_sorted = assume_sorted
 
         self._check_start_end_date()
     
     def fit(self, X: pd.DataFrame, y=None):
        
-       ## check if the date column exists
-        if self._check_date_column(X):
-            self.data = X
-        else:
-            raise ValueError(f"Date column {self.date_column} not found in DataFrame")
-        
-        ## check if the date column is a datetime column, 
-        ## if not, convert it to datetime using the date_str_format
-        self._check_date_column_type(self.date_str_format)
+        ## check if the date column exists, X itself is never modified
+        self._check_date_column(X)
+
+        ## string dates are parsed when filtering, once per distinct value (see schema.parse_dates)
+        self._check_date_column_type(X)
 
         ## check if the start and end date are valid
         self._check_start_end_date()
@@ -32,17 +46,51 @@ class DateFilter(BaseEstimator, TransformerMixin):
         return self
 
     def transform(self, X: pd.DataFrame) -> pd.DataFrame:
-        return X.query(f"{self.date_column} >= @self.start_date and {self.date_column} <= @self.end_date")
+        return self.filter(X, self.start_date, self.end_date)
+
+    def filter(self, X: pd.DataFrame, start_date=None, end_date=None) -> pd.DataFrame:
+        """
+        Rows of X between start_date and end_date (both included, None leaves the side open).
+        Cheap to call repeatedly with different windows on the same sorted frame (e.g. backtest
+        cutoffs) with assume_sorted=True, which skips the sortedness check.
+        """
+        dates = self._dates(X)
+        start_date = None if start_date is None else pd.Timestamp(start_date)
+        end_date = None if end_date is None else pd.Timestamp(end_date)
+
+        if self._is_sorted(dates):
+            start = 0 if start_date is None else dates.searchsorted(start_date, side='left')
+            stop = len(dates) if end_date is None else dates.searchsorted(end_date, side='right')
+            return X.iloc[start:max(start, stop)]
+
+        mask = np.ones(len(dates), dtype=bool)
+        if start_date is not None:
+            mask &= (dates >= start_date).to_numpy()
+        if end_date is not None:
+            mask &= (dates <= end_date).to_numpy()
+        return X[mask]
+
+    def _dates(self, X: pd.DataFrame) -> pd.Series:
+        dates = X[self.date_column]
+        if pd.api.types.is_datetime64_any_dtype(dates):
+            return dates
+        ## parse_dates parses each distinct string once
+        return parse_dates(dates, self.date_str_format)
+
+    def _is_sorted(self, dates: pd.Series) -> bool:
+        if self.assume_sorted is not None:
+            return self.assume_sorted
+        ## a single pass, done on every call since the data may have changed in place since the last one
+        return bool(dates.is_monotonic_increasing)
 
     def _check_date_column(self, X: pd.DataFrame) -> bool:
         if self.date_column not in X.columns:
             raise ValueError(f"Date column {self.date_column} not found in DataFrame")
         return True
 
-    def _check_date_column_type(self, date_str_format: str) -> bool:
-        if not pd.api.types.is_datetime64_any_dtype(self.data[self.date_column]):
-            logger.warning(f"Date column {self.date_column} is not a datetime column, it will be converted to datetime")
-            self.data[self.date_column] = pd.to_datetime(self.data[self.date_column], format=date_str_format)
+    def _check_date_column_type(self, X: pd.DataFrame) -> bool:
+        if not pd.api.types.is_datetime64_any_dtype(X[self.date_column]):
+            logger.debug(f"Date column {self.date_column} is not a datetime column, it will be parsed with {self.date_str_format}")
         return True
 
     def _check_start_end_date(self) -> bool:
@@ -62,8 +110,503 @@ class DateFilter(BaseEstimator, TransformerMixin):
 
 
 
-def split_data(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    pass
+def load_data(path: str, date_filter: DateFilter = None, columns: list = None, compact: bool = False) -> pd.DataFrame:
+    """
+    Load the dataset at path with only columns and, given a date_filter, only the rows in its date
+    range. The range is pushed down into the reader (see storage.read_date_range), so rows outside
+    it are skipped while reading instead of being loaded and dropped by the filter afterwards.
+    """
+    if date_filter is None:
+        return read_dataset(path, columns=columns, compact=compact)
+
+    return read_date_range(
+        path,
+        date_filter.date_column,
+        start_date=date_filter.start_date,
+        end_date=date_filter.end_date,
+        columns=columns,
+        compact=compact,
+        date_format=date_filter.date_str_format,
+        assume_sorted=bool(date_filter.assume_sorted)
+    )
+
+
+def _day_numbers(df: pd.DataFrame, date_column: str, date_str_format: str = '%Y-%m-%d') -> np.ndarray:
+    ## days since 1970-01-01 of each row, as integers
+    dates = df[date_column]
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = parse_dates(dates, date_str_format)
+    if dates.isna().any():
+        raise ValueError(f"Date column {date_column} has missing values")
+    return dates.to_numpy().astype('datetime64[ns]').view(np.int64) // NANOSECONDS_PER_DAY
+
+
+WINDOWS = ('expanding', 'sliding')
+## per month (0 = January) cyclical encoding and quarter
+MONTH_SIN = np.sin(2 * np.pi * np.arange(12) / 12).astype(np.float32)
+MONTH_COS = np.cos(2 * np.pi * np.arange(12) / 12).astype(np.float32)
+MONTH_QUARTER = (np.arange(12) // 3 + 1).astype(np.int8)
+NANOSECONDS_PER_DAY = 86_400 * 10 ** 9
+
+
+class RollingOriginSplitter:
+    """
+    Rolling origin backtest folds over data sorted by date_column (by group_column, then date,
+    when given). Fold k validates on the horizon days starting at its cutoff and trains on the days
+    before cutoff - gap: all of them for an expanding window, the last train_days for a sliding one.
+    The last fold ends on the last date and the cutoffs are step days apart (horizon by default),
+    on calendar days shared by every group, so the folds of all routes are aligned.
+
+    Folds are positional [start, stop) ranges found by binary search, so each one is a slice
+    (X.iloc[train]) sharing the memory of X, and the ranges are cheap to hand to parallel workers.
+    """
+    def __init__(self, date_column: str = 'operation_date', horizon: int = 30, n_splits: int = 5, gap: int = 0,
+                 step: int = None, window: str = 'expanding', train_days: int = None, group_column: str = None,
+                 date_str_format: str = '%Y-%m-%d'):
+        self.date_column = date_column
+        self.horizon = horizon
+        self.n_splits = n_splits
+        self.gap = gap
+        self.step = step
+        self.window = window
+        self.train_days = train_days
+        self.group_column = group_column
+        self.date_str_format = date_str_format
+
+        self._check_params()
+
+    def _check_params(self):
+        if self.window not in WINDOWS:
+            raise ValueError(f"Window {self.window} not supported, choose one of {WINDOWS}")
+        if self.window == 'sliding' and not self.train_days:
+            raise ValueError("A sliding window needs train_days")
+        if self.horizon < 1 or self.n_splits < 1 or self.gap < 0:
+            raise ValueError("horizon and n_splits must be positive and gap non negative")
+
+    def get_n_splits(self, X=None, y=None, groups=None) -> int:
+        return self.n_splits
+
+    def cutoffs(self, X: pd.DataFrame) -> pd.DatetimeIndex:
+        """
+        First validation day of each fold
+        """
+        days = self._days(X)
+        return pd.DatetimeIndex((days.min() + self._boundary_days(days)[:, 2]).astype('datetime64[D]').astype('datetime64[ns]'))
+
+    def boundaries(self, X: pd.DataFrame) -> np.ndarray:
+        """
+        Positions of every fold in X as an (n_splits, n_groups, 4) array of
+        [train_start, train_stop, validation_start, validation_stop], one group when there is no group_column
+        """
+        days = self._days(X)
+        first_day = days.min()
+        span = int(days.max() - first_day) + 1
+        ## day boundaries clipped to the data, so they can be offset per group without overlapping
+        bounds = np.clip(self._boundary_days(days), 0, span)
+
+        if self.group_column is None:
+            codes, num_groups = np.zeros(len(days), dtype=np.int64), 1
+        else:
+            codes, uniques = pd.factorize(X[self.group_column], sort=False)
+            num_groups = len(uniques)
+
+        ## one sorted key per row (group, day), every boundary of every group found in a single searchsorted
+        keys = codes * (span + 1) + (days - first_day)
+        if len(keys) and (np.diff(keys) < 0).any():
+            order = 'date' if self.group_column is None else f"{self.group_column} then date"
+            raise ValueError(f"Data must be sorted by {order} to be split, e.g. with sort_values(kind='stable')")
+        group_offsets = np.arange(num_groups)[None, :, None] * (span + 1)
+        return np.searchsorted(keys, bounds[:, None, :] + group_offsets, side='left')
+
+    def split(self, X: pd.DataFrame, y=None, groups=None):
+        """
+        Yield a (train, validation) pair of slices per fold, per fold and group (fold major) with a
+        group_column; X.iloc[train] and X.iloc[validation] are views of X
+        """
+        for fold in self.boundaries(X):
+            for train_start, train_stop, validation_start, validation_stop in fold:
+                yield slice(train_start, train_stop), slice(validation_start, validation_stop)
+
+    def _days(self, X: pd.DataFrame) -> np.ndarray:
+        if X.empty:
+            raise ValueError("Cannot split an empty DataFrame")
+        return _day_numbers(X, self.date_column, self.date_str_format)
+
+    def _boundary_days(self, days: np.ndarray) -> np.ndarray:
+        ## [train_start, train_stop, validation_start, validation_stop) per fold, in days after the first date
+        span = int(days.max() - days.min()) + 1
+        step = self.step or self.horizon
+        validation_start = span - self.horizon - step * np.arange(self.n_splits - 1, -1, -1)
+        train_stop = validation_start - self.gap
+        if train_stop[0] <= 0:
+            raise ValueError(f"{self.n_splits} folds of {self.horizon} days every {step} days with a {self.gap} day gap do not fit in {span} days")
+
+        train_start = np.zeros_like(train_stop) if self.window == 'expanding' else train_stop - self.train_days
+        return np.stack([train_start, train_stop, validation_start, validation_start + self.horizon], axis=1)
+
+
+def split_data(df: pd.DataFrame, date_column: str = 'operation_date', horizon: int = 30, gap: int = 0,
+               train_days: int = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Train / validation split of df sorted by date_column: the last horizon days validate, the days
+    before them (minus gap, only the last train_days when given) train. Both are views of df.
+    """
+    splitter = RollingOriginSplitter(
+        date_column=date_column,
+        horizon=horizon,
+        n_splits=1,
+        gap=gap,
+        window='expanding' if train_days is None else 'sliding',
+        train_days=train_days
+    )
+    train, validation = next(splitter.split(df))
+    return df.iloc[train], df.iloc[validation]
+
+class RoutePanel:
+    """
+    Daily series of a RouteAggregator as dense (series x day) arrays: keys holds one row per series
+    (its group column values), dates the calendar days, count the operations of each series and
+    day, and sums the daily sum of each value column. Days without operations have a zero count.
+    """
+    def __init__(self, keys: pd.DataFrame, dates: pd.DatetimeIndex, count: np.ndarray, sums: dict):
+        self.keys = keys
+        self.dates = dates
+        self.count = count
+        self.sums = sums
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.count.shape
+
+    @property
+    def series_ids(self) -> pd.Index:
+        return pd.Index(self.keys.astype(str).agg('|'.join, axis=1), name='unique_id')
+
+    def sum(self, column: str) -> np.ndarray:
+        return self.sums[column]
+
+    def mean(self, column: str, fill: str = None) -> np.ndarray:
+        """
+        Daily mean of column, NaN on days without operations, or the last day with operations
+        before them with fill='ffill' (days before the first operation of a series stay NaN)
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sums[column] / self.count
+        if fill == 'ffill':
+            mean = _forward_fill(mean)
+        elif fill is not None:
+            raise ValueError(f"Fill {fill} not supported, use 'ffill' or None")
+        return mean
+
+    def to_frame(self, column: str, stat: str = 'mean', fill: str = None, dropna: bool = True) -> pd.DataFrame:
+        """
+        Long frame (unique_id, ds, column) of one daily statistic ('mean', 'sum' or 'count'), the
+        layout of the forecasting libraries
+        """
+        if stat == 'mean':
+            values = self.mean(column, fill)
+        elif stat in ('sum', 'count'):
+            values = self.count if stat == 'count' else self.sums[column]
+        else:
+            raise ValueError(f"Statistic {stat} not supported, choose one of ('mean', 'sum', 'count')")
+
+        num_series, num_days = values.shape
+        frame = pd.DataFrame({
+            'unique_id': pd.Categorical.from_codes(np.repeat(np.arange(num_series), num_days), categories=self.series_ids),
+            'ds': np.tile(self.dates.to_numpy(), num_series),
+            column: values.ravel()
+        })
+        return frame[frame[column].notna()].reset_index(drop=True) if dropna else frame
+
+
+class RouteAggregator(BaseEstimator, TransformerMixin):
+    """
+    Aggregate operations into daily series, one per combination of group_columns (route and
+    commodity by default) present in the data, as a RoutePanel densified over every day between the
+    first and last date (or start_date / end_date when given, dropping the rows outside them).
+
+    Groups and days are integer codes combined into one cell index per row, and the counts and
+    sums of every cell come from bincount: a single sort free pass per column, with no groupby and
+    no reindex per series.
+    """
+    def __init__(self, date_column: str = 'operation_date', group_columns: tuple = ('route', 'commodity'),
+                 value_columns: tuple = ('value_per_ton', 'tonnage', 'total_freight_value'),
+                 start_date: str = None, end_date: str = None, date_str_format: str = '%Y-%m-%d'):
+        self.date_column = date_column
+        self.group_columns = group_columns
+        self.value_columns = value_columns
+        self.start_date = start_date
+        self.end_date = end_date
+        self.date_str_format = date_str_format
+
+    def fit(self, X: pd.DataFrame, y=None):
+        missing = [column for column in [self.date_column, *self.group_columns, *self.value_columns] if column not in X.columns]
+        if missing:
+            raise ValueError(f"Columns {missing} not found in DataFrame")
+        return self
+
+    def transform(self, X: pd.DataFrame) -> RoutePanel:
+        self.fit(X)
+        days = _day_numbers(X, self.date_column, self.date_str_format)
+        first_day = int(days.min()) if self.start_date is None else _day_number(self.start_date)
+        last_day = int(days.max()) if self.end_date is None else _day_number(self.end_date)
+        num_days = max(last_day - first_day + 1, 0)
+
+        ## mixed radix code of the groups of each row, over every combination of the group values
+        group_code = np.zeros(len(X), dtype=np.int64)
+        group_values = []
+        for column in self.group_columns:
+            codes, uniques = _sorted_codes(X[column])
+            ## a missing value gets code -1, which would land its rows in another group
+            if (codes < 0).any():
+                raise ValueError(f"Group column {column} has missing values")
+            group_code = group_code * len(uniques) + codes
+            group_values.append(uniques)
+
+        ## only the combinations present become series, renumbered in key order
+        in_range = (days >= first_day) & (days <= last_day)
+        if not in_range.all():
+            group_code, days = group_code[in_range], days[in_range]
+        num_combinations = int(np.prod([len(uniques) for uniques in group_values]))
+        present = np.bincount(group_code, minlength=num_combinations) > 0
+        series_code = np.cumsum(present) - 1
+        num_series = int(present.sum())
+
+        cells = series_code[group_code] * num_days + (days - first_day)
+        size = num_series * num_days
+        count = np.bincount(cells, minlength=size).astype(np.int32).reshape(num_series, num_days)
+        sums = {}
+        for column in self.value_columns:
+            values = X[column].to_numpy(dtype=np.float64)
+            values = values if in_range.all() else values[in_range]
+            sums[column] = np.bincount(cells, weights=values, minlength=size).reshape(num_series, num_days)
+
+        key_codes = np.unravel_index(np.flatnonzero(present), [len(uniques) for uniques in group_values])
+        keys = pd.DataFrame({column: uniques[codes] for column, uniques, codes in zip(self.group_columns, group_values, key_codes)})
+        dates = pd.DatetimeIndex(np.datetime64(first_day, 'D') + np.arange(num_days), name=self.date_column).as_unit('ns')
+
+        logger.info(f"Aggregated {int(in_range.sum())} operations into {num_series} series of {num_days} days")
+        return RoutePanel(keys, dates, count, sums)
+
+
+class FeatureEngineer:
+    """
+    Lag, rolling and momentum features of every daily series of a long (id_column, time_column,
+    target_column) frame, e.g. RoutePanel.to_frame(column, fill='ffill'), computed for all series in
+    one batched call of mlforecast's compiled lag transforms on num_threads threads (0 uses every
+    CPU available to the pod). Rolling statistics and momentum (ratio of a short to a long rolling
+    mean) use the values up to the previous day only.
+
+    The last values of each series are kept after fit_transform, so update() computes the features
+    of newly appended days from them instead of going over the whole history again.
+    """
+    def __init__(self, lags: tuple = (7, 14, 30), rolling_windows: tuple = (7, 14, 30), momentum: tuple = ((7, 30),),
+                 target_column: str = 'y', id_column: str = 'unique_id', time_column: str = 'ds', num_threads: int = 0):
+        self.lags = lags
+        self.rolling_windows = rolling_windows
+        self.momentum = momentum
+        self.target_column = target_column
+        self.id_column = id_column
+        self.time_column = time_column
+        self.num_threads = num_threads
+        self.history = None
+
+    @property
+    def history_days(self) -> int:
+        ## values before a day that its features depend on
+        return max([*self.lags, *self.rolling_windows, *[long for _, long in self.momentum], 1])
+
+    def fit_transform(self, df: pd.DataFrame, dropna: bool = True) -> pd.DataFrame:
+        """
+        df with the features of every row, the first days of each series lack some of them and are
+        dropped unless dropna=False
+        """
+        features = self._features(df, dropna)
+        self.history = self._tail(df)
+        return features
+
+    def update(self, df: pd.DataFrame, dropna: bool = True) -> pd.DataFrame:
+        """
+        Features of the rows of df, days appended after those already seen (new series start from
+        scratch). Same values as fit_transform over the whole history, at the cost of the new days.
+        """
+        if self.history is None:
+            raise ValueError("FeatureEngineer must be fitted before update")
+
+        last_seen = self.history.groupby(self.id_column, observed=True)[self.time_column].max()
+        seen_until = df[self.id_column].map(last_seen)
+        if (df[self.time_column] <= seen_until).any():
+            raise ValueError(f"update expects only days after the last {self.time_column} of each series")
+
+        combined = pd.concat([self.history, df], ignore_index=True).sort_values([self.id_column, self.time_column], kind='stable')
+        is_new = combined.index.to_numpy() >= len(self.history)
+        features = self._features(combined, dropna=False)[is_new]
+
+        self.history = self._tail(combined)
+        features = features.dropna() if dropna else features
+        return features.reset_index(drop=True)
+
+    def forecaster(self, models=(), date_features: tuple = ()) -> MLForecast:
+        """
+        MLForecast computing these features, fitting models on them (plus date_features) when given
+        """
+        return MLForecast(
+            models=models if isinstance(models, dict) else list(models),
+            freq='D',
+            lags=list(self.lags),
+            lag_transforms={1: self._lag_transforms()},
+            date_features=list(date_features),
+            num_threads=self.num_threads or available_cpus(),
+            lag_transforms_namer=_feature_name
+        )
+
+    def _features(self, df: pd.DataFrame, dropna: bool) -> pd.DataFrame:
+        self._check_daily(df)
+        return self.forecaster().preprocess(
+            df,
+            id_col=self.id_column,
+            time_col=self.time_column,
+            target_col=self.target_column,
+            static_features=[],
+            dropna=dropna
+        )
+
+    def _lag_transforms(self) -> list:
+        rolling = [
+            transform(window)
+            for window in self.rolling_windows
+            for transform in (RollingMean, RollingStd, RollingMin, RollingMax)
+        ]
+        momentum = [Combine(RollingMean(short), RollingMean(long), operator.truediv) for short, long in self.momentum]
+        return rolling + momentum
+
+    def _tail(self, df: pd.DataFrame) -> pd.DataFrame:
+        ## the last history_days values of each series, all the next days' features depend on
+        columns = [self.id_column, self.time_column, self.target_column]
+        return df[columns].groupby(self.id_column, observed=True).tail(self.history_days).reset_index(drop=True)
+
+    def _check_daily(self, df: pd.DataFrame):
+        ## lags are positional, so each series must be sorted with one row per consecutive day
+        ids = df[self.id_column].to_numpy()
+        days = _day_numbers(df, self.time_column)
+        same_series = ids[1:] == ids[:-1]
+        if (same_series & (np.diff(days) != 1)).any():
+            raise ValueError("Series must be sorted by day with no missing days, e.g. RoutePanel.to_frame(column, fill='ffill')")
+
+
+def _feature_name(transform, lag, *args) -> str:
+    ## rolling_mean_7, rolling_std_30, momentum_7_30
+    if isinstance(transform, Combine):
+        return f"momentum_{transform.tfm1.window_size}_{transform.tfm2.window_size}"
+    name = re.sub(r'(?<!^)(?=[A-Z])', '_', type(transform).__name__).lower()
+    return f"{name}_{transform.window_size}"
+
+
+def available_cpus() -> int:
+    """
+    CPUs this process may use: the cgroup cpu quota of the pod when there is one, else the CPUs it
+    is allowed to run on
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(int(quota) // int(period), 1))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def _sorted_codes(values: pd.Series) -> Tuple[np.ndarray, pd.Index]:
+    ## integer codes of values numbering the distinct values in sorted order (categoricals keep their categories)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy().astype(np.int64), values.cat.categories
+    codes, uniques = pd.factorize(values, sort=True)
+    return codes.astype(np.int64), uniques
+
+
+def _day_number(date) -> int:
+    return int(pd.Timestamp(date).to_datetime64().astype('datetime64[D]').astype(np.int64))
+
+
+def _forward_fill(values: np.ndarray) -> np.ndarray:
+    ## along the last axis: each NaN takes the value of the last valid position before it
+    positions = np.where(np.isnan(values), 0, np.arange(values.shape[-1]))
+    np.maximum.accumulate(positions, axis=-1, out=positions)
+    return np.take_along_axis(values, positions, axis=-1)
+
+
+def generate_seasonality_features(df: pd.DataFrame, commodities: dict = None, commodity_column: str = 'commodity',
+                                  date_column: str = 'operation_date', date_str_format: str = '%Y-%m-%d') -> pd.DataFrame:
+    """
+    Seasonality features of each row of df, indexed like df:
+    is_harvest (the commodity is harvested in the month of the row), month_sin / month_cos
+    (cyclical month), quarter and weeks_to_harvest (weeks to the first day of the next harvest
+    month of the commodity, 0 during the harvest, NaN for commodities never harvested or unknown).
+
+    commodities maps names to their 'harvest_seasonality' months, the generator topology by
+    default. The lookup tables are built once per harvest calendar and every feature is an array
+    lookup on the commodity codes and months, with no per row or per commodity Python.
+    """
+    if commodities is None:
+        _, _, commodities, _ = load_topology(TOPOLOGY_PATH)
+    names, is_harvest, months_to_harvest = _harvest_tables(
+        tuple((name, tuple(commodity['harvest_seasonality'])) for name, commodity in commodities.items())
+    )
+
+    ## commodity codes: the categories (or distinct values) are mapped to table rows, unknown ones to the last row
+    commodity = df[commodity_column]
+    if isinstance(commodity.dtype, pd.CategoricalDtype):
+        codes, uniques = commodity.cat.codes.to_numpy(), commodity.cat.categories
+    else:
+        codes, uniques = pd.factorize(commodity)
+    rows = np.append(pd.Index(names).get_indexer(uniques), -1)
+    rows[rows < 0] = len(names)
+    commodity_rows = rows[codes]
+
+    days = _day_numbers(df, date_column, date_str_format)
+
+    ## a date column spans a few hundred days: the features are tabulated per commodity and day
+    ## of that span, and each row only picks its (commodity, day) entry
+    first_day = int(days.min()) if len(days) else 0
+    num_days = int(days.max()) - first_day + 1 if len(days) else 1
+    span_days = np.datetime64(first_day, 'D') + np.arange(num_days)
+    span_months = span_days.astype('datetime64[M]')
+    months = span_months.astype(np.int64) % 12
+    ahead = months_to_harvest[:, months]
+    next_harvest = (span_months + np.nan_to_num(ahead).astype(np.int64)).astype('datetime64[D]')
+    weeks_to_harvest = np.where(ahead > 0, (next_harvest - span_days).astype(np.float32) / 7, ahead)
+
+    day_idx = days - first_day
+    cells = commodity_rows * num_days + day_idx
+    features = np.empty((3, len(df)), dtype=np.float32)
+    np.take(MONTH_SIN[months], day_idx, out=features[0], mode='clip')
+    np.take(MONTH_COS[months], day_idx, out=features[1], mode='clip')
+    np.take(weeks_to_harvest.astype(np.float32).ravel(), cells, out=features[2], mode='clip')
+
+    ## the float features are a single block, so the frame is built without copying them
+    seasonality = pd.DataFrame(features.T, index=df.index, columns=['month_sin', 'month_cos', 'weeks_to_harvest'], copy=False)
+    seasonality.insert(0, 'is_harvest', is_harvest[:, months].ravel()[cells])
+    seasonality.insert(3, 'quarter', MONTH_QUARTER[months][day_idx])
+    return seasonality
+
+
+@lru_cache(maxsize=8)
+def _harvest_tables(calendar: tuple):
+    """
+    Commodity x month (0 = January) tables for a harvest calendar of (name, months) pairs: harvest
+    flag and months until the next harvest month (0 when harvesting). The extra last row stands for
+    unknown commodities, never harvested.
+    """
+    names = [name for name, _ in calendar]
+    is_harvest = np.zeros((len(names) + 1, 12), dtype=bool)
+    for row, (_, months) in enumerate(calendar):
+        is_harvest[row, np.asarray(months, dtype=np.int64) - 1] = True
+
+    ## months ahead of each month, wrapping over the year: first harvest month in that order
+    ahead = (np.arange(12)[:, None] + np.arange(12)[None, :]) % 12
+    upcoming = is_harvest[:, ahead]
+    months_to_harvest = np.where(upcoming.any(axis=2), upcoming.argmax(axis=2), np.nan).astype(np.float32)
 
-def generate_seasonality_features(df: pd.DataFrame) -> pd.DataFrame:
-    pass
\ No newline at end of file
+    return names, is_harvest, months_to_harvest
\ No newline at end of file
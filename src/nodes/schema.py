@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+DATE_COLUMN = 'operation_date'
+CATEGORICAL_COLUMNS = ['origin_municipality', 'origin_state', 'destination_port', 'destination_state', 'commodity', 'route']
+FLOAT_COLUMNS = [
+    'origin_lat', 'origin_lon', 'destination_lat', 'destination_lon', 'tonnage', 'distance_km',
+    'total_freight_value', 'value_per_ton', 'commodity_reference_price'
+]
+SMALL_INT_COLUMNS = ['month', 'year']
+## parsed date strings are kept per format across calls, up to this many strings per format
+MAX_CACHED_DATES = 100_000
+COLUMNS = [
+    'operation_date', 'origin_municipality', 'origin_state', 'origin_lat', 'origin_lon', 'destination_port',
+    'destination_state', 'destination_lat', 'destination_lon', 'commodity', 'tonnage', 'distance_km',
+    'total_freight_value', 'value_per_ton', 'commodity_reference_price', 'month', 'year', 'route'
+]
+
+
+def compact_dtypes(columns=None):
+    """
+    Compact dtype per logistics column (operation_date excluded, it is parsed as a date)
+    """
+    dtypes = {column: 'category' for column in CATEGORICAL_COLUMNS}
+    dtypes.update({column: np.float32 for column in FLOAT_COLUMNS})
+    dtypes.update({column: np.int16 for column in SMALL_INT_COLUMNS})
+    if columns is not None:
+        dtypes = {column: dtype for column, dtype in dtypes.items() if column in columns}
+    return dtypes
+
+
+def compact_frame(df: pd.DataFrame, date_format: str = '%Y-%m-%d') -> pd.DataFrame:
+    """
+    Copy of df in the compact logistics schema: low cardinality strings as categoricals,
+    measures as float32, month/year as int16 and operation_date as datetime64.
+    Columns outside the schema are kept as they are.
+    """
+    df = df.astype(compact_dtypes(df.columns))
+    if DATE_COLUMN in df.columns and not pd.api.types.is_datetime64_any_dtype(df[DATE_COLUMN]):
+        df[DATE_COLUMN] = parse_dates(df[DATE_COLUMN], date_format)
+    return df
+
+
+_parsed_dates = {}
+
+
+def parse_dates(values: pd.Series, date_format: str = '%Y-%m-%d') -> pd.Series:
+    """
+    values parsed as datetime64 with date_format. Only the distinct values are parsed, and only the
+    first time they are seen: the column is factorized into integer codes (a categorical already
+    is) and the codes index a table of parsed dates memoized across calls, since a date column
+    holds a few hundred distinct days however many rows it has. Missing values become NaT.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+
+    parsed = _parsed_dates.setdefault(date_format, {})
+    missing = [value for value in uniques if value not in parsed]
+    if missing:
+        if len(parsed) + len(missing) > MAX_CACHED_DATES:
+            parsed.clear()
+        parsed.update(zip(missing, pd.to_datetime(pd.Index(missing, dtype=object), format=date_format).asi8))
+
+    ## the last entry is NaT, for the -1 code of missing values
+    table = np.fromiter((parsed[value] for value in uniques), dtype=np.int64, count=len(uniques))
+    table = np.append(table, np.iinfo(np.int64).min).view('datetime64[ns]')
+    return pd.Series(table[codes], index=values.index, name=values.name)
\ No newline at end of file
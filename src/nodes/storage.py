@@ -0,0 +1,321 @@
+import csv
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from loguru import logger
+from src.nodes.schema import DATE_COLUMN, compact_dtypes, compact_frame, parse_dates
+
+FORMATS = ('csv', 'parquet', 'arrow')
+EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+PARTITION_COLUMNS = ['year', 'month']
+ROWS_PER_GROUP = 131_072
+
+
+def check_format(output_format):
+    if output_format not in FORMATS:
+        raise ValueError(f"Format {output_format} not supported, choose one of {FORMATS}")
+
+
+def dataset_path(output_dir, file_name, output_format):
+    """
+    Path of the dataset for file_name in the given format: a single file for csv, a directory
+    partitioned by year/month for the columnar formats
+    """
+    check_format(output_format)
+    stem, _ = os.path.splitext(file_name)
+    return os.path.join(output_dir, f"{stem}{EXTENSIONS[output_format]}")
+
+
+def path_format(path):
+    for output_format, ext in EXTENSIONS.items():
+        if path.endswith(ext):
+            return output_format
+    raise ValueError(f"Could not infer the dataset format of {path}")
+
+
+def remove_dataset(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def to_arrow_table(df):
+    """
+    Arrow table for df with every string column dictionary encoded
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            table = table.set_column(i, field.name, pc.dictionary_encode(table.column(i)))
+    return table
+
+
+class DatasetWriter:
+    """
+    Incremental writer for a csv file or a year/month partitioned parquet / arrow IPC dataset.
+    Chunks go to a temporary path that replaces the dataset on close, so readers never see a
+    partially written dataset. With append=True the rows are added to the existing dataset
+    instead, also on close only: the staged csv rows appended to the csv file in one copy (the
+    file is truncated back to its previous size if the copy fails), or new files (named with
+    prefix, which must sort after the existing ones) moved into the partitions.
+    """
+    def __init__(self, path, output_format='csv', compression='zstd', append=False, prefix='part'):
+        check_format(output_format)
+        self.path = path
+        self.output_format = output_format
+        self.compression = compression
+        self.append = append
+        self.prefix = prefix
+        self.tmp_path = f"{path}.tmp"
+        self.num_rows = 0
+        self.num_chunks = 0
+
+        remove_dataset(self.tmp_path)
+        if self.output_format != 'csv':
+            os.makedirs(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            remove_dataset(self.tmp_path)
+
+    def write(self, df):
+        if self.output_format == 'csv':
+            first = self.num_chunks == 0
+            header = first and not (self.append and os.path.exists(self.path))
+            df.to_csv(self.tmp_path, index=False, mode='w' if first else 'a', header=header)
+        elif len(df):
+            ds.write_dataset(
+                to_arrow_table(df),
+                self.tmp_path,
+                format=self._file_format(),
+                file_options=self._file_options(),
+                partitioning=PARTITION_COLUMNS,
+                partitioning_flavor='hive',
+                basename_template=f"{self.prefix}-{self.num_chunks:05d}-{{i}}{EXTENSIONS[self.output_format]}",
+                existing_data_behavior='overwrite_or_ignore',
+                max_rows_per_group=ROWS_PER_GROUP
+            )
+        self.num_rows += len(df)
+        self.num_chunks += 1
+        logger.debug(f"Chunk {self.num_chunks} written to {self.path}, {self.num_rows} rows")
+
+    def close(self):
+        if self.append and self.output_format == 'csv':
+            if self.num_chunks:
+                self._append_csv()
+            remove_dataset(self.tmp_path)
+        elif self.append:
+            for root, _, names in os.walk(self.tmp_path):
+                partition_dir = os.path.join(self.path, os.path.relpath(root, self.tmp_path))
+                os.makedirs(partition_dir, exist_ok=True)
+                for name in names:
+                    os.replace(os.path.join(root, name), os.path.join(partition_dir, name))
+            remove_dataset(self.tmp_path)
+        else:
+            remove_dataset(self.path)
+            os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def _append_csv(self):
+        ## a crash halfway through the copy must not leave a partial last line for last_value to read
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        try:
+            with open(self.tmp_path, 'rb') as source, open(self.path, 'ab') as target:
+                shutil.copyfileobj(source, target)
+        except BaseException:
+            with open(self.path, 'r+b') as target:
+                target.truncate(size)
+            raise
+
+    def _file_format(self):
+        return 'parquet' if self.output_format == 'parquet' else 'ipc'
+
+    def _file_options(self):
+        if self.output_format == 'parquet':
+            return ds.ParquetFileFormat().make_write_options(compression=self.compression, use_dictionary=True)
+        return ds.IpcFileFormat().make_write_options(compression=self.compression)
+
+
+def open_dataset(path):
+    """
+    pyarrow dataset over a csv file or a partitioned parquet / arrow directory
+    """
+    output_format = path_format(path)
+    if output_format == 'csv':
+        return ds.dataset(path, format='csv')
+    return ds.dataset(path, format='parquet' if output_format == 'parquet' else 'ipc', partitioning='hive')
+
+
+def sorted_fragments(dataset):
+    """
+    Fragments of a partitioned dataset in chronological (year, month) order, then by file name
+    """
+    def key(fragment):
+        partition = ds.get_partition_keys(fragment.partition_expression)
+        return tuple(partition.get(column, 0) for column in PARTITION_COLUMNS) + (fragment.path,)
+    return sorted(dataset.get_fragments(), key=key)
+
+
+def read_chunks(path, chunk_size, columns=None, compact=False):
+    """
+    Yield the rows of a dataset as DataFrames of at most chunk_size rows, keeping the file order
+    for csv and the chronological partition order for the columnar formats
+    """
+    if path_format(path) == 'csv':
+        for chunk in pd.read_csv(path, chunksize=chunk_size, usecols=columns, dtype=_csv_dtypes(compact)):
+            yield compact_frame(chunk) if compact else chunk
+        return
+
+    dataset = open_dataset(path)
+    for fragment in sorted_fragments(dataset):
+        for batch in fragment.to_batches(schema=dataset.schema, columns=columns, batch_size=chunk_size):
+            yield compact_frame(batch.to_pandas()) if compact else batch.to_pandas()
+
+
+def last_value(path, column):
+    """
+    Value of column in the last row of a dataset sorted by it, reading only the end of a csv
+    file or the last partition of a columnar dataset. None when the dataset is empty.
+    """
+    if path_format(path) == 'csv':
+        with open(path, 'rb') as f:
+            header = f.readline()
+            size = f.seek(0, os.SEEK_END)
+            block = 4096
+            while True:
+                f.seek(max(size - block, 0))
+                lines = f.read().splitlines()
+                if len(lines) >= 2 or block >= size:
+                    break
+                block *= 2
+        if not lines or lines[-1] == header.rstrip(b'\r\n'):
+            return None
+        names = next(csv.reader([header.decode()]))
+        return next(csv.reader([lines[-1].decode()]))[names.index(column)]
+
+    dataset = open_dataset(path)
+    fragments = sorted_fragments(dataset)
+    if not fragments:
+        return None
+    values = fragments[-1].to_table(schema=dataset.schema, columns=[column]).column(column)
+    if pa.types.is_dictionary(values.type):
+        values = values.cast(values.type.value_type)
+    return pc.max(values).as_py()
+
+
+def read_dataset(path, columns=None, compact=False):
+    """
+    Read a whole dataset, optionally in the compact schema (see schema.compact_frame)
+    """
+    if path_format(path) == 'csv':
+        df = pd.read_csv(path, usecols=columns, dtype=_csv_dtypes(compact))
+    else:
+        dataset = open_dataset(path)
+        tables = [fragment.to_table(schema=dataset.schema, columns=columns) for fragment in sorted_fragments(dataset)]
+        df = (pa.concat_tables(tables) if tables else dataset.to_table(columns=columns)).to_pandas()
+    return compact_frame(df) if compact else df
+
+
+def read_date_range(path, date_column, start_date=None, end_date=None, columns=None, compact=False,
+                    date_format='%Y-%m-%d', assume_sorted=False, chunk_size=1_000_000):
+    """
+    Read the rows of a dataset with date_column between start_date and end_date (both included,
+    None leaves the side open), keeping only columns. The range is pushed down into the reader:
+    columnar datasets skip the year/month partitions outside it and parquet row groups whose
+    statistics exclude it, csv files are streamed in chunks filtered as they are read, stopping at
+    the first chunk past end_date when assume_sorted. Rows outside the range are never collected.
+    """
+    start_date = None if start_date is None else pd.Timestamp(start_date)
+    end_date = None if end_date is None else pd.Timestamp(end_date)
+    read_columns = None if columns is None else list(dict.fromkeys([*columns, date_column]))
+
+    if path_format(path) == 'csv':
+        frames = []
+        for chunk in pd.read_csv(path, chunksize=chunk_size, usecols=read_columns, dtype=_csv_dtypes(compact)):
+            dates = parse_dates(chunk[date_column], date_format)
+            mask = np.ones(len(chunk), dtype=bool)
+            if start_date is not None:
+                mask &= (dates >= start_date).to_numpy()
+            if end_date is not None:
+                mask &= (dates <= end_date).to_numpy()
+            if mask.any():
+                frames.append(chunk[mask])
+            if assume_sorted and end_date is not None and len(chunk) and dates.iloc[-1] > end_date:
+                break
+        df = concat_frames(frames) if frames else pd.read_csv(path, nrows=0, usecols=read_columns)
+    else:
+        dataset = open_dataset(path)
+        date_filter = _date_range_expression(date_column, dataset.schema.field(date_column).type, start_date, end_date, date_format)
+        tables = [
+            fragment.to_table(schema=dataset.schema, columns=read_columns, filter=date_filter)
+            for fragment in sorted_fragments(dataset)
+            if _partition_in_range(fragment, start_date, end_date)
+        ]
+        df = (pa.concat_tables(tables) if tables else dataset.schema.empty_table().select(read_columns or dataset.schema.names)).to_pandas()
+
+    if columns is not None:
+        df = df[list(columns)]
+    logger.info(f"Read {len(df)} rows of {path} between {start_date} and {end_date}")
+    return compact_frame(df, date_format) if compact else df
+
+
+def concat_frames(frames):
+    """
+    Concatenate DataFrames keeping their categorical columns categorical, over the union of the
+    categories of every frame (a plain concat falls back to object when the categories differ)
+    """
+    frames = list(frames)
+    for column in frames[0].columns:
+        if not isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            continue
+        categories = pd.api.types.union_categoricals([frame[column] for frame in frames]).categories
+        frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def _date_range_expression(date_column, date_type, start_date, end_date, date_format):
+    ## compare with scalars of the stored type, timestamps or date strings (dictionary encoded or not),
+    ## the latter assuming a date_format that sorts as text, such as the default ISO format
+    def scalar(value):
+        if pa.types.is_timestamp(date_type):
+            return pa.scalar(value, date_type)
+        return pa.scalar(value.strftime(date_format))
+
+    expression = None
+    if start_date is not None:
+        expression = ds.field(date_column) >= scalar(start_date)
+    if end_date is not None:
+        upper = ds.field(date_column) <= scalar(end_date)
+        expression = upper if expression is None else expression & upper
+    return expression
+
+
+def _partition_in_range(fragment, start_date, end_date):
+    ## a year/month partition can only hold rows of its month
+    partition = ds.get_partition_keys(fragment.partition_expression)
+    if not all(column in partition for column in PARTITION_COLUMNS):
+        return True
+    month = (int(partition['year']), int(partition['month']))
+    if start_date is not None and month < (start_date.year, start_date.month):
+        return False
+    if end_date is not None and month > (end_date.year, end_date.month):
+        return False
+    return True
+
+
+def _csv_dtypes(compact):
+    ## parse straight into the compact dtypes instead of converting object columns afterwards,
+    ## the dates as categorical so that only their distinct values are parsed as dates
+    if not compact:
+        return None
+    return {**compact_dtypes(), DATE_COLUMN: 'category'}
\ No newline at end of file
@@ -0,0 +1,519 @@
+import heapq
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from loguru import logger
+from sklearn.base import clone
+from sklearn.compose import make_column_selector, make_column_transformer
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.linear_model import LinearRegression, Ridge
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import OneHotEncoder
+from threadpoolctl import threadpool_limits
+from src.nodes.columnar import ColumnStore
+from src.nodes.preprocessing import (MONTH_COS, MONTH_SIN, FeatureEngineer, RouteAggregator, RoutePanel, available_cpus,
+                                     generate_seasonality_features)
+
+## estimators trained for each series, cloned per fit
+MODELS = {
+    'linear': LinearRegression(),
+    'ridge': Ridge(alpha=1.0),
+    'gbm': HistGradientBoostingRegressor(max_iter=200, learning_rate=0.05)
+}
+## global models, fitted once on every series with the group columns as categorical features
+GLOBAL_MODELS = {
+    'ridge': make_pipeline(
+        make_column_transformer(
+            (OneHotEncoder(handle_unknown='ignore'), make_column_selector(dtype_include='category')),
+            remainder='passthrough'
+        ),
+        Ridge(alpha=1.0)
+    ),
+    'gbm': HistGradientBoostingRegressor(max_iter=200, learning_rate=0.05, categorical_features='from_dtype')
+}
+SEASONALITY_FEATURES = ['is_harvest', 'month_sin', 'month_cos', 'quarter']
+## columns of the training frame besides the features, and of the forecasts
+ID_COLUMN, TIME_COLUMN, TARGET_COLUMN, PREDICTION_COLUMN = 'unique_id', 'ds', 'y', 'y_hat'
+## batches per worker when routes_per_batch is automatic, so that workers finishing early pick up another one
+BATCHES_PER_WORKER = 4
+
+## feature store opened by each pool worker
+_store = None
+
+
+def route_series(df: pd.DataFrame, target_column: str = 'value_per_ton', group_columns: tuple = ('route', 'commodity'),
+                 date_column: str = 'operation_date') -> pd.DataFrame:
+    """
+    Daily series of the forward filled mean of target_column per group, in the long layout of the
+    forecasting libraries (unique_id, ds, y) plus the group columns as categorical static features
+    """
+    panel = RouteAggregator(date_column, tuple(group_columns), value_columns=(target_column,)).transform(df)
+    return panel_series(panel, target_column)
+
+
+def panel_series(panel: RoutePanel, target_column: str = 'value_per_ton') -> pd.DataFrame:
+    """
+    route_series of the series of a RoutePanel
+    """
+    series = panel.to_frame(target_column, fill='ffill').rename(columns={target_column: TARGET_COLUMN})
+    codes = series[ID_COLUMN].cat.codes.to_numpy()
+    for column in panel.keys.columns:
+        key_codes, key_values = pd.factorize(panel.keys[column], sort=True)
+        series[column] = pd.Categorical.from_codes(key_codes[codes], categories=key_values)
+    return series
+
+
+def build_training_frame(df: pd.DataFrame, target_column: str = 'value_per_ton', group_columns: tuple = ('route', 'commodity'),
+                         date_column: str = 'operation_date', lags: tuple = (7, 14, 30), rolling_windows: tuple = (7, 14, 30),
+                         num_threads: int = 0) -> pd.DataFrame:
+    """
+    Training rows of every daily series of df: the forward filled daily mean of target_column per
+    group (y), its lag / rolling / momentum features and the seasonality features, sorted by series
+    (unique_id) and day (ds) so that each series is a contiguous block of rows
+    """
+    series = route_series(df, target_column, group_columns, date_column)
+    features = FeatureEngineer(tuple(lags), tuple(rolling_windows), num_threads=num_threads).fit_transform(series)
+
+    ## each series' commodity, if it is one of the groups, drives the harvest features
+    commodity = features['commodity'] if 'commodity' in features.columns else np.full(len(features), None)
+    seasonality = generate_seasonality_features(pd.DataFrame({'commodity': commodity, TIME_COLUMN: features[TIME_COLUMN]}), date_column=TIME_COLUMN)
+    return pd.concat([features.drop(columns=list(group_columns)), seasonality[SEASONALITY_FEATURES].astype(np.float64)], axis=1)
+
+
+def series_slices(store: ColumnStore) -> pd.DataFrame:
+    """
+    Row range [start, stop) of each series of a store sorted by series, read from the id codes only
+    """
+    series_ids = store.categories(ID_COLUMN)
+    counts = np.bincount(store.column(ID_COLUMN), minlength=len(series_ids))
+    stops = np.cumsum(counts)
+    slices = pd.DataFrame({
+        ID_COLUMN: series_ids,
+        'start': stops - counts,
+        'stop': stops
+    })
+    return slices[counts > 0].reset_index(drop=True)
+
+
+def pack_batches(slices: pd.DataFrame, num_batches: int) -> list:
+    """
+    Split series into num_batches lists of (series id, start, stop) with about as many rows each:
+    largest series first, each to the batch with the fewest rows so far
+    """
+    batches = [[] for _ in range(max(min(num_batches, len(slices)), 1))]
+    heap = [(0, i) for i in range(len(batches))]
+    for series_id, start, stop in sorted(slices.itertuples(index=False), key=lambda row: row[1] - row[2]):
+        rows, i = heapq.heappop(heap)
+        batches[i].append((series_id, int(start), int(stop)))
+        heapq.heappush(heap, (rows + stop - start, i))
+    return [batch for batch in batches if batch]
+
+
+def month_sin(dates: pd.DatetimeIndex) -> np.ndarray:
+    return MONTH_SIN[dates.month - 1]
+
+
+def month_cos(dates: pd.DatetimeIndex) -> np.ndarray:
+    return MONTH_COS[dates.month - 1]
+
+
+def forecast_metrics(y_true: np.ndarray, y_pred: np.ndarray) -> dict:
+    """
+    MAE, RMSE and MAPE (in %, over the non zero actual values)
+    """
+    error = y_pred - y_true
+    nonzero = y_true != 0
+    return {
+        'mae': float(np.mean(np.abs(error))) if len(error) else np.nan,
+        'rmse': float(np.sqrt(np.mean(error ** 2))) if len(error) else np.nan,
+        'mape': float(np.mean(np.abs(error[nonzero] / y_true[nonzero])) * 100) if nonzero.any() else np.nan
+    }
+
+
+def series_metrics(ids: pd.Series, y_true: np.ndarray, y_pred: np.ndarray) -> pd.DataFrame:
+    """
+    forecast_metrics of each series of ids, summed per series code with bincount
+    """
+    codes, series_ids = pd.factorize(ids, sort=True)
+    counts = np.bincount(codes, minlength=len(series_ids))
+    error = y_pred - y_true
+    nonzero = y_true != 0
+    ape = np.abs(np.divide(error, y_true, out=np.zeros_like(error), where=nonzero))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return pd.DataFrame({
+            ID_COLUMN: series_ids,
+            'mae': np.bincount(codes, np.abs(error), len(series_ids)) / counts,
+            'rmse': np.sqrt(np.bincount(codes, error ** 2, len(series_ids)) / counts),
+            'mape': np.bincount(codes, ape, len(series_ids)) / np.bincount(codes, nonzero, len(series_ids)) * 100
+        })
+
+
+def recursive_forecast(models: list, history: np.ndarray, seasonality: np.ndarray, lags: tuple = (7, 14, 30),
+                       rolling_windows: tuple = (7, 14, 30), momentum: tuple = ((7, 30),)) -> np.ndarray:
+    """
+    Forecasts (series x days) of every series by its own model (NaN where it is None) for the
+    seasonality.shape[1] days after history (series x its last history_days days), day by day with
+    each day's features (those of build_training_frame) computed from the days before it, forecasts
+    included. Every series is forecast at once each day: the linear models stacked into one
+    coefficient matrix and the gradient boosting models into one StackedTrees; other models raise,
+    the global mode handles them.
+    """
+    linear = np.array([_is_linear(model) for model in models], dtype=bool)
+    trees = np.array([_is_tree_ensemble(model) for model in models], dtype=bool)
+    unsupported = [type(model).__name__ for row, model in enumerate(models) if model is not None and not (linear[row] or trees[row])]
+    if unsupported:
+        raise ValueError(f"{len(unsupported)} models cannot be batched, e.g. {unsupported[0]}: per route "
+                         f"forecasts support linear and gradient boosting models, use the global mode for other models")
+    coefficients = np.stack([models[row].coef_ for row in np.flatnonzero(linear)]) if linear.any() else None
+    intercepts = np.array([models[row].intercept_ for row in np.flatnonzero(linear)])
+    ensembles = StackedTrees([models[row] for row in np.flatnonzero(trees)]) if trees.any() else None
+
+    num_series, horizon = seasonality.shape[:2]
+    history_days = history.shape[1]
+    values = np.concatenate([history, np.full((num_series, horizon), np.nan)], axis=1)
+    for step in range(horizon):
+        features = _step_features(values[:, step:step + history_days], lags, rolling_windows, momentum, seasonality[:, step])
+        forecast = np.full(num_series, np.nan)
+        if coefficients is not None:
+            forecast[linear] = np.einsum('ij,ij->i', features[linear], coefficients) + intercepts
+        if ensembles is not None:
+            forecast[trees] = ensembles.predict(features[trees])
+        values[:, history_days + step] = forecast
+    return values[:, history_days:]
+
+
+def _step_features(past: np.ndarray, lags: tuple, rolling_windows: tuple, momentum: tuple, seasonality: np.ndarray) -> np.ndarray:
+    ## the features of the day after past (series x history days), in the order of build_training_frame:
+    ## lags, mean / std / min / max per window, momentum, seasonality
+    columns = [past[:, -lag] for lag in lags]
+    for window in rolling_windows:
+        values = past[:, -window:]
+        columns += [values.mean(axis=1), values.std(axis=1, ddof=1), values.min(axis=1), values.max(axis=1)]
+    columns += [past[:, -short:].mean(axis=1) / past[:, -long:].mean(axis=1) for short, long in momentum]
+    return np.column_stack([*columns, seasonality])
+
+
+class StackedTrees:
+    """
+    The trees of several HistGradientBoostingRegressor models (squared error, numeric features)
+    concatenated into flat node arrays, so that each row of features is predicted by its own model
+    in one traversal of every tree of every row at once, one tree level per numpy step, instead of
+    one predict call per model. Predictions match each model's predict up to float rounding.
+    """
+    def __init__(self, models: list):
+        nodes = [[predictors[0].nodes for predictors in model._predictors] for model in models]
+        if any(tree['is_categorical'].any() for trees in nodes for tree in trees):
+            raise ValueError("Gradient boosting models with categorical splits cannot be stacked")
+
+        ## node 0 is a leaf of value 0, the root of the missing trees of models with fewer iterations
+        sizes = [len(tree) for trees in nodes for tree in trees]
+        offsets = np.cumsum([1, *sizes])
+        stacked = np.concatenate([np.zeros(1, dtype=nodes[0][0].dtype), *(tree for trees in nodes for tree in trees)])
+        stacked['is_leaf'][0] = 1
+        tree_offsets = np.repeat(offsets[:-1], sizes)
+
+        self.value = stacked['value']
+        self.feature = stacked['feature_idx']
+        self.threshold = stacked['num_threshold']
+        self.missing_left = stacked['missing_go_to_left'].astype(bool)
+        self.is_leaf = stacked['is_leaf'].astype(bool)
+        self.left = np.concatenate([[0], stacked['left'][1:] + tree_offsets]).astype(np.int64)
+        self.right = np.concatenate([[0], stacked['right'][1:] + tree_offsets]).astype(np.int64)
+
+        self.roots = np.zeros((len(models), max(len(trees) for trees in nodes)), dtype=np.int64)
+        first = 0
+        for row, trees in enumerate(nodes):
+            self.roots[row, :len(trees)] = offsets[first:first + len(trees)]
+            first += len(trees)
+        self.baseline = np.array([float(np.ravel(model._baseline_prediction)[0]) for model in models])
+
+    def predict(self, features: np.ndarray) -> np.ndarray:
+        """
+        Prediction of the i-th model for the i-th row of features
+        """
+        ## one entry per (row, tree), only those not at a leaf yet go down a level
+        num_rows, num_trees = self.roots.shape
+        nodes = self.roots.ravel().copy()
+        rows = np.repeat(np.arange(num_rows), num_trees)
+        active = np.flatnonzero(~self.is_leaf[nodes])
+        while len(active):
+            current = nodes[active]
+            values = features[rows[active], self.feature[current]]
+            go_left = np.where(np.isnan(values), self.missing_left[current], values <= self.threshold[current])
+            following = np.where(go_left, self.left[current], self.right[current])
+            nodes[active] = following
+            active = active[~self.is_leaf[following]]
+        return self.value[nodes].reshape(num_rows, num_trees).sum(axis=1) + self.baseline
+
+
+def _is_linear(model) -> bool:
+    ## a single output linear model predicts features @ coef_ + intercept_
+    return model is not None and hasattr(model, 'coef_') and np.ndim(model.coef_) == 1 and np.ndim(model.intercept_) == 0
+
+
+def _is_tree_ensemble(model) -> bool:
+    ## a fitted squared error gradient boosting regressor, whose raw prediction is its prediction
+    return isinstance(model, HistGradientBoostingRegressor) and model.loss == 'squared_error' and hasattr(model, '_predictors')
+
+
+class TrainingResult:
+    """
+    Fitted models keyed by (series id, model name) and one metrics row per series and model
+    """
+    def __init__(self, models: dict, metrics: pd.DataFrame):
+        self.models = models
+        self.metrics = metrics
+
+    @classmethod
+    def merge(cls, results: list) -> 'TrainingResult':
+        models = {key: model for result in results for key, model in result.models.items()}
+        metrics = pd.concat([result.metrics for result in results], ignore_index=True)
+        return cls(models, metrics)
+
+    def best(self, metric: str = 'mae') -> pd.DataFrame:
+        """
+        Metrics row of the model with the lowest metric for each series
+        """
+        ranked = self.metrics.dropna(subset=[metric]).sort_values(metric, kind='stable')
+        return ranked.drop_duplicates(ID_COLUMN).sort_values(ID_COLUMN).reset_index(drop=True)
+
+
+class RouteTrainer:
+    """
+    Train every model of models on every series of a feature store (see build_training_frame and
+    ColumnStore), validating each on its last horizon days forecast recursively like inference does
+    (see recursive_forecast, lags / rolling_windows / momentum are those of the store) and refitting
+    it on the whole series when refit.
+
+    Series are packed into batches of about the same number of rows, routes_per_batch series each
+    (0 sizes them for BATCHES_PER_WORKER batches per worker), and the batches are trained by a pool
+    of num_workers processes (0 uses every CPU available to the pod). Each worker opens the store
+    memory mapped once and only reads the rows of its series, so the pool shares one copy of the
+    data, and linear algebra runs single threaded in each worker so workers don't compete for cores.
+    """
+    def __init__(self, models: tuple = ('ridge',), horizon: int = 30, routes_per_batch: int = 0, num_workers: int = 0,
+                 refit: bool = True, min_train_rows: int = 60, lags: tuple = (7, 14, 30), rolling_windows: tuple = (7, 14, 30),
+                 momentum: tuple = ((7, 30),)):
+        self.models = models
+        self.horizon = horizon
+        self.routes_per_batch = routes_per_batch
+        self.num_workers = num_workers
+        self.refit = refit
+        self.min_train_rows = min_train_rows
+        self.lags = lags
+        self.rolling_windows = rolling_windows
+        self.momentum = momentum
+
+    def fit(self, store_path: str, shard: int = 0, num_shards: int = 1) -> TrainingResult:
+        """
+        Train the series of the store, or the shard-th of num_shards groups of them (with about as
+        many rows each) when the training is split over several pods
+        """
+        unknown = [name for name in self.models if name not in MODELS]
+        if unknown:
+            raise ValueError(f"Models {unknown} not supported, choose from {list(MODELS)}")
+
+        store = ColumnStore(store_path)
+        slices = series_slices(store)
+        if num_shards > 1:
+            groups = pack_batches(slices, num_shards)
+            shard_ids = [series_id for series_id, _, _ in groups[shard]] if shard < len(groups) else []
+            slices = slices[slices[ID_COLUMN].isin(shard_ids)]
+
+        num_workers = self.num_workers or available_cpus()
+        routes_per_batch = self.routes_per_batch or math.ceil(len(slices) / (num_workers * BATCHES_PER_WORKER))
+        batches = pack_batches(slices, math.ceil(len(slices) / max(routes_per_batch, 1)))
+        feature_columns = [column for column in store.columns if column not in (ID_COLUMN, TIME_COLUMN, TARGET_COLUMN)]
+        args = (self.models, feature_columns, self.horizon, self.refit, self.min_train_rows,
+                tuple(self.lags), tuple(self.rolling_windows), tuple(self.momentum))
+
+        start = time.perf_counter()
+        if num_workers == 1 or len(batches) == 1:
+            _open_store(store_path)
+            with threadpool_limits(1):
+                outputs = [_train_batch(batch, *args) for batch in batches]
+        else:
+            with ProcessPoolExecutor(max_workers=min(num_workers, len(batches)), initializer=_init_worker, initargs=(store_path,)) as pool:
+                futures = [pool.submit(_train_batch, batch, *args) for batch in batches]
+                outputs = [future.result() for future in as_completed(futures)]
+
+        models = {key: model for batch_models, _ in outputs for key, model in batch_models.items()}
+        metrics = pd.DataFrame([row for _, rows in outputs for row in rows])
+        if not metrics.empty:
+            metrics = metrics.sort_values([ID_COLUMN, 'model']).reset_index(drop=True)
+        logger.info(
+            f"Trained {len(self.models)} models on {len(slices)} series in {len(batches)} batches "
+            f"with {num_workers} workers in {time.perf_counter() - start:.1f}s"
+        )
+        return TrainingResult(models, metrics)
+
+
+class GlobalTrainer:
+    """
+    One model for every series (global model) with mlforecast: the lag / rolling / momentum
+    features of FeatureEngineer, calendar features and the group columns of route_series (route,
+    commodity) as categorical static features. A single fit covers every series, and a single
+    recursive predict forecasts every series and every day of the horizon.
+    """
+    def __init__(self, model: str = 'gbm', lags: tuple = (7, 14, 30), rolling_windows: tuple = (7, 14, 30),
+                 momentum: tuple = ((7, 30),), static_columns: tuple = ('route', 'commodity'), num_threads: int = 0):
+        self.model = model
+        self.lags = lags
+        self.rolling_windows = rolling_windows
+        self.momentum = momentum
+        self.static_columns = static_columns
+        self.num_threads = num_threads
+        self.forecast = None
+        self.categories = {}
+
+    def fit(self, series: pd.DataFrame) -> 'GlobalTrainer':
+        """
+        Fit the model on every day of every series of a route_series frame
+        """
+        if self.model not in GLOBAL_MODELS:
+            raise ValueError(f"Global model {self.model} not supported, choose from {list(GLOBAL_MODELS)}")
+        ## the model sees the static columns as category codes, kept to encode later series the same way
+        self.categories = {column: series[column].cat.categories for column in self.static_columns}
+        engineer = FeatureEngineer(tuple(self.lags), tuple(self.rolling_windows), tuple(self.momentum), num_threads=self.num_threads)
+        self.forecast = engineer.forecaster(models={self.model: clone(GLOBAL_MODELS[self.model])}, date_features=(month_sin, month_cos, 'quarter'))
+        self.forecast.fit(
+            series[[ID_COLUMN, TIME_COLUMN, TARGET_COLUMN, *self.static_columns]],
+            id_col=ID_COLUMN,
+            time_col=TIME_COLUMN,
+            target_col=TARGET_COLUMN,
+            static_features=list(self.static_columns)
+        )
+        return self
+
+    def predict(self, horizon: int, series: pd.DataFrame = None) -> pd.DataFrame:
+        """
+        Forecasts (unique_id, ds, y_hat) of the horizon days after the end of every series the
+        model was fitted on, or of every series of a newer route_series frame when given
+        """
+        if self.forecast is None:
+            raise ValueError("GlobalTrainer must be fitted before predict")
+        if series is not None:
+            series = series[[ID_COLUMN, TIME_COLUMN, TARGET_COLUMN, *self.static_columns]].astype({
+                column: pd.CategoricalDtype(categories) for column, categories in self.categories.items()
+            })
+        return self.forecast.predict(horizon, new_df=series).rename(columns={self.model: PREDICTION_COLUMN})
+
+    def validate(self, series: pd.DataFrame, horizon: int) -> pd.DataFrame:
+        """
+        Metrics of each series forecasting its last horizon days, fitted on the days before them
+        """
+        train, validation = _holdout(series, horizon)
+        forecasts = validation.merge(self.fit(train).predict(horizon), on=[ID_COLUMN, TIME_COLUMN])
+        metrics = series_metrics(forecasts[ID_COLUMN], forecasts[TARGET_COLUMN].to_numpy(), forecasts[PREDICTION_COLUMN].to_numpy())
+        metrics.insert(1, 'model', self.model)
+        return metrics
+
+
+def benchmark_modes(series: pd.DataFrame, horizon: int = 30, model: str = 'gbm', static_columns: tuple = ('route', 'commodity'),
+                    **feature_params) -> pd.DataFrame:
+    """
+    Time and accuracy of the global mode against the per route mode, on the same features and
+    model: one GlobalTrainer fit and predict over every series, against one fit and predict per
+    series. Both forecast the last horizon days of every series, fitted on the days before them,
+    and the metrics pool every forecast.
+    """
+    train, validation = _holdout(series, horizon)
+    ids = validation[ID_COLUMN].cat.remove_unused_categories()
+    actual = pd.DataFrame({ID_COLUMN: ids.to_numpy(), TIME_COLUMN: validation[TIME_COLUMN].to_numpy(), TARGET_COLUMN: validation[TARGET_COLUMN].to_numpy()})
+
+    def evaluate(mode, fits, fit_seconds, predict_seconds, forecasts):
+        forecasts = actual.merge(forecasts.astype({ID_COLUMN: object}), on=[ID_COLUMN, TIME_COLUMN])
+        return {
+            'mode': mode,
+            'fits': fits,
+            'fit_seconds': fit_seconds,
+            'predict_seconds': predict_seconds,
+            'forecasts': len(forecasts),
+            **forecast_metrics(forecasts[TARGET_COLUMN].to_numpy(), forecasts[PREDICTION_COLUMN].to_numpy())
+        }
+
+    start = time.perf_counter()
+    trainer = GlobalTrainer(model, static_columns=tuple(static_columns), **feature_params).fit(train)
+    fitted = time.perf_counter()
+    forecasts = trainer.predict(horizon)
+    rows = [evaluate('global', 1, fitted - start, time.perf_counter() - fitted, forecasts)]
+
+    ## the baseline: a loop over the series, the static columns are constant within each one
+    fit_seconds, predict_seconds, forecasts = 0.0, 0.0, []
+    for _, group in train.groupby(ID_COLUMN, observed=True, sort=False):
+        start = time.perf_counter()
+        trainer = GlobalTrainer(model, static_columns=(), **feature_params).fit(group.astype({ID_COLUMN: object}))
+        fitted = time.perf_counter()
+        forecasts.append(trainer.predict(horizon))
+        fit_seconds, predict_seconds = fit_seconds + fitted - start, predict_seconds + time.perf_counter() - fitted
+    rows.append(evaluate('per_route', train[ID_COLUMN].nunique(), fit_seconds, predict_seconds, pd.concat(forecasts, ignore_index=True)))
+
+    benchmark = pd.DataFrame(rows)
+    logger.info(f"Global vs per route {model} models over {len(actual)} forecasts:\n{benchmark.round(3).to_string(index=False)}")
+    return benchmark
+
+
+def _holdout(series: pd.DataFrame, horizon: int):
+    ## the last horizon days of each series against the days before them
+    last_day = series.groupby(ID_COLUMN, observed=True)[TIME_COLUMN].transform('max')
+    validation = (series[TIME_COLUMN] > last_day - pd.Timedelta(days=horizon)).to_numpy()
+    return series[~validation], series[validation]
+
+
+def _open_store(store_path: str):
+    global _store
+    _store = ColumnStore(store_path)
+
+
+def _init_worker(store_path: str):
+    _open_store(store_path)
+    ## one BLAS / OpenMP thread per worker process for its lifetime, the pool provides the parallelism
+    threadpool_limits(1)
+
+
+def _train_batch(batch: list, model_names: tuple, feature_columns: list, horizon: int, refit: bool, min_train_rows: int,
+                 lags: tuple, rolling_windows: tuple, momentum: tuple):
+    history_days = FeatureEngineer(lags, rolling_windows, momentum).history_days
+    series = []
+    for series_id, start, stop in batch:
+        frame = _store.to_frame([*feature_columns, TARGET_COLUMN], start, stop)
+        X = frame[feature_columns].to_numpy(dtype=np.float64)
+        y = frame[TARGET_COLUMN].to_numpy(dtype=np.float64)
+        split = len(y) - horizon
+        if split < max(min_train_rows, history_days):
+            logger.warning(f"Series {series_id} skipped, {len(y)} rows are not enough for {min_train_rows} training and {horizon} validation rows")
+            continue
+        series.append((series_id, X, y, split))
+    if not series:
+        return {}, []
+
+    ## the validation days of every series of the batch are forecast recursively from the days before
+    ## them, as inference forecasts the days ahead, rather than one step ahead from the actual lags
+    history = np.stack([y[split - history_days:split] for _, _, y, split in series])
+    seasonality = np.stack([X[split:, -len(SEASONALITY_FEATURES):] for _, X, _, split in series])
+
+    models, rows = {}, []
+    for name in model_names:
+        fitted, fit_seconds = [], []
+        for _, X, y, split in series:
+            fit_start = time.perf_counter()
+            fitted.append(clone(MODELS[name]).fit(X[:split], y[:split]))
+            fit_seconds.append(time.perf_counter() - fit_start)
+        forecasts = recursive_forecast(fitted, history, seasonality, lags, rolling_windows, momentum)
+
+        for (series_id, X, y, split), model, forecast, seconds in zip(series, fitted, forecasts, fit_seconds):
+            if refit:
+                fit_start = time.perf_counter()
+                model = clone(MODELS[name]).fit(X, y)
+                seconds += time.perf_counter() - fit_start
+            models[(series_id, name)] = model
+            rows.append({
+                ID_COLUMN: series_id,
+                'model': name,
+                **forecast_metrics(y[split:], forecast),
+                'train_rows': split,
+                'fit_seconds': seconds
+            })
+    return models, rows
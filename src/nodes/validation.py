@@ -0,0 +1,282 @@
+import numpy as np
+import pandas as pd
+from loguru import logger
+from src.nodes.schema import CATEGORICAL_COLUMNS, COLUMNS, DATE_COLUMN, FLOAT_COLUMNS, SMALL_INT_COLUMNS, parse_dates
+
+## accepted [low, high] per column, None leaves a side open
+RANGES = {
+    'tonnage': (0.0, 100.0),
+    'value_per_ton': (0.0, 5_000.0),
+    'distance_km': (0.0, 6_000.0),
+    'total_freight_value': (0.0, None),
+    'commodity_reference_price': (0.0, None),
+    'month': (1, 12),
+    'origin_lat': (-34.0, 6.0),
+    'destination_lat': (-34.0, 6.0),
+    'origin_lon': (-74.0, -28.0),
+    'destination_lon': (-74.0, -28.0)
+}
+## robust z-score above which a value is an outlier of its route (Iglewicz and Hoaglin)
+OUTLIER_THRESHOLD = 3.5
+MAX_EXAMPLES = 5
+## days since the epoch shifted to be non negative, packed with the route code in one int64
+DAY_OFFSET = 2 ** 31
+DAY_MASK = 2 ** 32 - 1
+
+
+class ValidationReport:
+    """
+    Violations found by OperationsValidator, one row per failed check with the number of rows
+    involved and a few example row positions. Errors make the data unusable, warnings are kept
+    for the record.
+    """
+    def __init__(self, num_rows: int, violations: list):
+        self.num_rows = num_rows
+        self.violations = pd.DataFrame(violations, columns=['check', 'column', 'severity', 'count', 'examples', 'detail'])
+
+    @property
+    def passed(self) -> bool:
+        return not (self.violations['severity'] == 'error').any()
+
+    def summary(self) -> dict:
+        return {
+            'num_rows': self.num_rows,
+            'passed': self.passed,
+            'violations': self.violations.to_dict('records')
+        }
+
+    def log(self):
+        if self.violations.empty:
+            logger.info(f"Validation passed, {self.num_rows} rows without violations")
+            return
+        for violation in self.violations.itertuples():
+            log = logger.error if violation.severity == 'error' else logger.warning
+            examples = f" (e.g. rows {violation.examples})" if violation.examples else ''
+            log(f"{violation.check} {violation.column}: {violation.count} {violation.detail}{examples}")
+
+
+def validate_operations(df: pd.DataFrame, ranges: dict = None, route_column: str = 'route', max_gap_days: int = 7,
+                        outlier_columns: tuple = ('value_per_ton',), outlier_threshold: float = OUTLIER_THRESHOLD,
+                        date_format: str = '%Y-%m-%d') -> ValidationReport:
+    """
+    Check a logistics dataset (plain or compact schema) held in memory, see OperationsValidator
+    """
+    validator = OperationsValidator(ranges, route_column, max_gap_days, outlier_columns, outlier_threshold, date_format)
+    return validator.update(df).report()
+
+
+def validate_chunks(chunks, **kwargs) -> ValidationReport:
+    """
+    Check a dataset read as a sequence of DataFrames (e.g. storage.read_chunks), holding only one
+    chunk and the per route state of OperationsValidator in memory
+    """
+    validator = OperationsValidator(**kwargs)
+    for chunk in chunks:
+        validator.update(chunk)
+    return validator.report()
+
+
+class OperationsValidator:
+    """
+    Check a logistics dataset (plain or compact schema) chunk by chunk in columnar passes and report
+    every violation instead of stopping at the first one:
+    schema (missing columns, non numeric measures), missing values, value ranges and coordinate
+    bounds, freight value consistency, month / year against the date, date order, days without
+    operations longer than max_gap_days inside each route's history, and per route outliers by
+    robust z-score (median / MAD), computed on integer route codes with no groupby.
+
+    Row checks are counted as the chunks come; across chunks only the last date, the sorted unique
+    (route, day) codes of the active days and the route codes / values of the outlier columns are
+    kept, so the result is the same as validating the whole dataset at once.
+    """
+    def __init__(self, ranges: dict = None, route_column: str = 'route', max_gap_days: int = 7,
+                 outlier_columns: tuple = ('value_per_ton',), outlier_threshold: float = OUTLIER_THRESHOLD,
+                 date_format: str = '%Y-%m-%d'):
+        self.ranges = RANGES if ranges is None else ranges
+        self.route_column = route_column
+        self.max_gap_days = max_gap_days
+        self.outlier_columns = outlier_columns
+        self.outlier_threshold = outlier_threshold
+        self.date_format = date_format
+
+        self.num_rows = 0
+        ## (check, column) -> [severity, count, examples, detail], in the order first found
+        self._violations = {}
+        self._last_day = None
+        self._routes = pd.Index([])
+        self._active_days = []
+        self._outlier_rows = []
+        self._outlier_codes = []
+        self._outlier_values = {column: [] for column in outlier_columns}
+
+    def update(self, df: pd.DataFrame) -> 'OperationsValidator':
+        """
+        Check the next chunk of rows
+        """
+        offset = self.num_rows
+        self.num_rows += len(df)
+
+        def report(check, column, mask_or_count, detail, severity='error'):
+            self._report(check, column, mask_or_count, detail, severity, offset)
+
+        ## schema
+        missing_columns = [column for column in COLUMNS if column not in df.columns]
+        for column in missing_columns:
+            report('schema', column, len(df), 'rows without the column')
+        numeric_columns = [column for column in FLOAT_COLUMNS + SMALL_INT_COLUMNS if column in df.columns]
+        for column in numeric_columns:
+            if not pd.api.types.is_numeric_dtype(df[column]):
+                report('schema', column, len(df), f"rows of dtype {df[column].dtype}, expected numeric")
+        numeric_columns = [column for column in numeric_columns if pd.api.types.is_numeric_dtype(df[column])]
+
+        ## missing values and ranges
+        values = {column: df[column].to_numpy(dtype=np.float64) for column in numeric_columns}
+        for column in [column for column in CATEGORICAL_COLUMNS if column in df.columns]:
+            report('missing', column, df[column].isna().to_numpy(), 'rows with missing values')
+        for column, column_values in values.items():
+            report('missing', column, np.isnan(column_values), 'rows with missing values')
+        for column, (low, high) in self.ranges.items():
+            if column not in values:
+                continue
+            with np.errstate(invalid='ignore'):
+                outside = np.zeros(len(df), dtype=bool)
+                if low is not None:
+                    outside |= values[column] < low
+                if high is not None:
+                    outside |= values[column] > high
+            report('range', column, outside, f"rows outside [{low}, {high}]")
+
+        ## the freight value is the cost per ton times the tonnage, up to rounding
+        if all(column in values for column in ('total_freight_value', 'value_per_ton', 'tonnage')):
+            expected = values['value_per_ton'] * values['tonnage']
+            with np.errstate(invalid='ignore'):
+                inconsistent = np.abs(values['total_freight_value'] - expected) > 0.01 * np.abs(expected) + 1.0
+            report('consistency', 'total_freight_value', inconsistent, 'rows differing from value_per_ton * tonnage')
+
+        if DATE_COLUMN not in df.columns:
+            return self
+
+        dates = df[DATE_COLUMN]
+        if not pd.api.types.is_datetime64_any_dtype(dates):
+            try:
+                dates = parse_dates(dates, self.date_format)
+            except (ValueError, TypeError) as error:
+                report('schema', DATE_COLUMN, len(df), f"rows, not parseable with {self.date_format}: {error}")
+                return self
+        valid_dates = dates.notna().to_numpy()
+        report('missing', DATE_COLUMN, ~valid_dates, 'rows with missing dates')
+        day_values = dates.to_numpy().astype('datetime64[D]')
+        days = day_values.astype(np.int64)
+
+        for column, unit in (('month', 'M'), ('year', 'Y')):
+            if column in values:
+                calendar = day_values.astype(f'datetime64[{unit}]').astype(np.int64)
+                calendar = calendar % 12 + 1 if unit == 'M' else calendar + 1970
+                report('consistency', column, valid_dates & (values[column] != calendar), f"rows not matching {DATE_COLUMN}")
+
+        ## the first valid date is compared with the last one of the previous chunk
+        valid_days = days[valid_dates]
+        if len(valid_days):
+            previous = valid_days[0] if self._last_day is None else self._last_day
+            backwards = np.zeros(len(df), dtype=bool)
+            backwards[np.flatnonzero(valid_dates)] = np.diff(valid_days, prepend=previous) < 0
+            report('order', DATE_COLUMN, backwards, 'rows with a date before the previous row', severity='warning')
+            self._last_day = valid_days[-1]
+
+        if self.route_column not in df.columns or not valid_dates.any():
+            return self
+
+        ## per route state on integer route codes, the same for a route in every chunk
+        route_codes = self._route_codes(df[self.route_column])
+        keep = valid_dates & (route_codes >= 0)
+        self._active_days.append(np.unique((route_codes[keep].astype(np.int64) << 32) | (days[keep] + DAY_OFFSET)))
+        if any(column in values for column in self.outlier_columns):
+            self._outlier_rows.append(np.flatnonzero(keep) + offset)
+            self._outlier_codes.append(route_codes[keep])
+            for column in self.outlier_columns:
+                self._outlier_values[column].append(values[column][keep] if column in values else np.full(keep.sum(), np.nan))
+        return self
+
+    def report(self) -> ValidationReport:
+        """
+        Report of every chunk checked so far, with the per route checks over all of them
+        """
+        violations = dict(self._violations)
+
+        ## consecutive active days of a route, from the sorted unique (route, day) codes
+        active = np.unique(np.concatenate(self._active_days)) if self._active_days else np.array([], dtype=np.int64)
+        active_routes, active_days = active >> 32, active & DAY_MASK
+        same_route = active_routes[1:] == active_routes[:-1]
+        gaps = np.diff(active_days) - 1
+        long_gaps = same_route & (gaps > self.max_gap_days)
+        if long_gaps.any():
+            gap_routes = self._routes[active_routes[1:][long_gaps]]
+            detail = f"gaps longer than {self.max_gap_days} days (longest {gaps[long_gaps].max()}), routes {sorted(set(gap_routes))[:MAX_EXAMPLES]}"
+            violations[('date_gap', self.route_column)] = ['warning', int(long_gaps.sum()), [], detail]
+
+        if self._outlier_codes:
+            rows, codes = np.concatenate(self._outlier_rows), np.concatenate(self._outlier_codes)
+            for column in self.outlier_columns:
+                column_values = np.concatenate(self._outlier_values[column])
+                if np.isnan(column_values).all():
+                    continue
+                outliers = np.abs(_robust_z_scores(codes, column_values, len(self._routes))) > self.outlier_threshold
+                if outliers.any():
+                    detail = f"rows with a robust z-score above {self.outlier_threshold} within their route"
+                    violations[('outlier', column)] = ['warning', int(outliers.sum()), rows[outliers][:MAX_EXAMPLES].tolist(), detail]
+
+        return ValidationReport(self.num_rows, [(check, column, *violation) for (check, column), violation in violations.items()])
+
+    def _report(self, check, column, mask_or_count, detail, severity, offset):
+        if isinstance(mask_or_count, np.ndarray):
+            count, examples = int(mask_or_count.sum()), (np.flatnonzero(mask_or_count)[:MAX_EXAMPLES] + offset).tolist()
+        else:
+            count, examples = int(mask_or_count), []
+        if not count:
+            return
+        if (check, column) not in self._violations:
+            self._violations[(check, column)] = [severity, 0, [], detail]
+        violation = self._violations[(check, column)]
+        violation[1] += count
+        violation[2] = (violation[2] + examples)[:MAX_EXAMPLES]
+
+    def _route_codes(self, routes: pd.Series) -> np.ndarray:
+        ## codes of the routes in the order first seen over every chunk, -1 for missing values
+        codes, uniques = pd.factorize(routes)
+        known = self._routes.get_indexer(uniques)
+        new = known < 0
+        if new.any():
+            known[new] = len(self._routes) + np.arange(new.sum())
+            self._routes = self._routes.append(pd.Index(np.asarray(uniques)[new]))
+        return np.where(codes >= 0, known[codes] if len(known) else codes, -1)
+
+
+def _robust_z_scores(codes: np.ndarray, values: np.ndarray, num_groups: int) -> np.ndarray:
+    ## 0.6745 * (x - median) / MAD with median and MAD per group code, NaN where the MAD is 0
+    median = _grouped_median(codes, values, num_groups)
+    deviation = values - median[codes]
+    mad = _grouped_median(codes, np.abs(deviation), num_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(mad[codes] > 0, 0.6745 * deviation / mad[codes], np.nan)
+
+
+def _grouped_median(codes: np.ndarray, values: np.ndarray, num_groups: int) -> np.ndarray:
+    ## values scaled into [0, 1) and offset by their group code sort by (group, value) in a single
+    ## np.sort, then the middle element(s) of each group's contiguous block are its median
+    finite = ~np.isnan(values)
+    codes, values = codes[finite], values[finite]
+    counts = np.bincount(codes, minlength=num_groups)
+    median = np.full(num_groups, np.nan)
+    if not len(values):
+        return median
+
+    low_value, value_range = values.min(), values.max() - values.min()
+    scale = value_range / (1 - 1e-9) if value_range > 0 else 1.0
+    sorted_values = (np.sort(codes + (values - low_value) / scale) - np.repeat(np.arange(num_groups), counts)) * scale + low_value
+
+    starts = np.cumsum(counts) - counts
+    has_rows = counts > 0
+    low = (starts + (counts - 1) // 2)[has_rows]
+    high = (starts + counts // 2)[has_rows]
+    median[has_rows] = (sorted_values[low] + sorted_values[high]) / 2
+    return median
@@ -1,8 +1,14 @@
 from metaflow import FlowSpec, step, Parameter, parallel
 from config.config import DATA_GEN_CONFIG
-from src.nodes.datagen import DataGenerator
+from src.nodes.datagen import DataGenerator, finalize_parts, resolve_path
+from src.nodes.cache import GenerationCache, file_digest
+from src.nodes.columnar import ColumnStore, store_path
+from src.nodes.schema import DATE_COLUMN
+from src.nodes.storage import last_value, read_chunks, read_dataset, read_date_range
+from src.nodes.validation import validate_chunks
 from loguru import logger
 import os
+import pandas as pd
 
 
 class DataGenFlow(FlowSpec):
@@ -49,25 +55,238 @@ class DataGenFlow(FlowSpec):
         help='Number of days for the operation dates'
     )
 
+    engine = Parameter(
+        'engine',
+        default=DATA_GEN_CONFIG.engine,
+        type=str,
+        help='Generation engine, numpy (vectorized) or python (row by row)'
+    )
+
+    output_format = Parameter(
+        'output_format',
+        default=DATA_GEN_CONFIG.output_format,
+        type=str,
+        help='Output format: csv, or parquet / arrow datasets partitioned by year and month'
+    )
+
+    compression = Parameter(
+        'compression',
+        default=DATA_GEN_CONFIG.compression,
+        type=str,
+        help='Compression codec for the parquet / arrow outputs'
+    )
+
+    compact = Parameter(
+        'compact',
+        default=DATA_GEN_CONFIG.compact,
+        type=bool,
+        help='Generate the data in the compact schema (categoricals, float32, datetime64)'
+    )
+
+    chunk_size = Parameter(
+        'chunk_size',
+        default=DATA_GEN_CONFIG.chunk_size,
+        type=int,
+        help='Rows per chunk when streaming to disk, 0 keeps the whole dataset in memory'
+    )
+
+    num_shards = Parameter(
+        'num_shards',
+        default=DATA_GEN_CONFIG.num_shards,
+        type=int,
+        help='Number of shards generated in parallel, each in its own foreach task'
+    )
+
+    shard_index = Parameter(
+        'shard_index',
+        default=DATA_GEN_CONFIG.shard_index,
+        type=int,
+        help='Index of the slice generated by this worker (Indexed Job completion index)'
+    )
+
+    shard_count = Parameter(
+        'shard_count',
+        default=DATA_GEN_CONFIG.shard_count,
+        type=int,
+        help='Number of workers splitting the generation, each running this flow'
+    )
+
+    use_cache = Parameter(
+        'use_cache',
+        default=DATA_GEN_CONFIG.use_cache,
+        type=bool,
+        help='Skip the generation when a dataset with the same parameters and code is on disk'
+    )
+
+    incremental = Parameter(
+        'incremental',
+        default=DATA_GEN_CONFIG.incremental,
+        type=bool,
+        help='Append only the days after the last operation_date on disk instead of regenerating'
+    )
+
+    until = Parameter(
+        'until',
+        default=DATA_GEN_CONFIG.until,
+        type=str,
+        help='Last day generated in incremental mode, today when empty'
+    )
+
+    validate_output = Parameter(
+        'validate_output',
+        default=DATA_GEN_CONFIG.validate_output,
+        type=bool,
+        help='Validate the generated dataset and fail the run on schema / range errors'
+    )
+
+    topology_path = Parameter(
+        'topology_path',
+        default=DATA_GEN_CONFIG.topology_path,
+        type=str,
+        help='Json file with the ports, municipalities, commodities and commodity weights per state'
+    )
+
+    column_store = Parameter(
+        'column_store',
+        default=DATA_GEN_CONFIG.column_store,
+        type=bool,
+        help='Write the dataset to a memory mapped column store that downstream steps open by path'
+    )
+
     @step
     def start(self):
-        self.generator_class = DataGenerator(
+        ## only the parameters are stored, each task builds its own generator
+        self.generator_params = dict(
             num_operations=self.num_operations,
             seed=self.seed,
             output_dir=self.output_dir,
             file_name=self.file_name,
             base_date=self.base_date,
-            range_days=self.range_days
+            range_days=self.range_days,
+            engine=self.engine,
+            chunk_size=self.chunk_size,
+            output_format=self.output_format,
+            compression=self.compression,
+            compact=self.compact,
+            topology_path=resolve_path(self.topology_path)
         )
         logger.info(f"Absolute path: {os.path.abspath(self.output_dir)}")
-        self.next(self.generate_data)
+        ## each worker owns a contiguous range of num_shards global shards
+        self.total_shards = self.shard_count * self.num_shards
+        self.shards = [self.shard_index * self.num_shards + i for i in range(self.num_shards)]
+
+        self.cache_key, self.data_ref = None, None
+        if self.incremental:
+            ## appending changes the dataset, so there is nothing to cache, and a single task appends
+            self.shards = self.shards[:1]
+            if self.shard_count > 1:
+                logger.warning(f"Incremental runs append from worker 0 only, worker {self.shard_index} of {self.shard_count} has nothing to do; run them with a single worker")
+        elif self.use_cache:
+            cache = GenerationCache(os.path.join(self.output_dir, '.cache'))
+            ## the output does not depend on how it is chunked or sharded, and the topology by content only
+            params = {k: v for k, v in self.generator_params.items() if k not in ('chunk_size', 'topology_path')}
+            self.cache_key = cache.key({**params, 'topology': file_digest(self.generator_params['topology_path'])})
+            self.data_ref = cache.lookup(self.cache_key)
+        self.cache_hit = self.data_ref is not None
+        if self.cache_hit:
+            self.shards = self.shards[:1]
+
+        self.next(self.generate_data, foreach='shards')
 
     @step
     def generate_data(self):
         """
-        Generate the data
+        Generate the data, or one shard of it when the run is sharded
+        """
+        self.shard = self.input
+        self.appended_after = None
+        if self.incremental:
+            generator = DataGenerator(**self.generator_params)
+            ## with several workers only the first one appends; the rows after the last day already
+            ## on disk are the only ones left to validate
+            if self.shard == 0:
+                self.appended_after = last_value(generator.output_path, DATE_COLUMN) if os.path.exists(generator.output_path) else None
+                self.rows_appended = generator.generate_incremental(self.until or None)
+            self.output_path = generator.output_path
+        elif not self.cache_hit:
+            generator = DataGenerator(**self.generator_params)
+            if self.total_shards > 1:
+                self.output_path = generator.generate_shard(self.shard, self.total_shards)
+            elif self.chunk_size:
+                self.output_path = generator.generate_streaming()
+            else:
+                generator.generate()
+                self.output_path = generator.output_path
+        else:
+            self.output_path = self.data_ref['output_path']
+        self.next(self.join_shards)
+
+    @step
+    def join_shards(self, inputs):
+        """
+        Merge the shard part files into the sorted output file, once the parts of every worker exist.
+        output_path is only set on the worker that produced the dataset (the one that merged the
+        parts, appended the new days or, on a cache hit, the first one), the only one validating it
+        and writing its column store
+        """
+        if inputs[0].cache_hit or inputs[0].incremental:
+            self.merge_artifacts(inputs, exclude=['shard', 'output_path'])
+            ## only the first worker appends or hands on the cached dataset
+            self.output_path = inputs[0].output_path if self.shard_index == 0 else None
+        elif inputs[0].total_shards > 1:
+            self.merge_artifacts(inputs, exclude=['shard', 'output_path'])
+            ## the last completion index fails the job if the parts of every worker never show up
+            self.output_path = finalize_parts(
+                self.output_dir,
+                self.file_name,
+                self.total_shards,
+                chunk_size=self.chunk_size or 1_000_000,
+                output_format=self.output_format,
+                compression=self.compression,
+                wait_seconds=DATA_GEN_CONFIG.merge_wait_seconds if self.shard_index == self.shard_count - 1 else 0
+            )
+        else:
+            self.merge_artifacts(inputs, exclude=['shard'])
+
+        self.next(self.validate_data)
+
+    @step
+    def validate_data(self):
         """
-        self.data = self.generator_class.generate()
+        Check the generated dataset before anything consumes it, failing the run on errors;
+        only a dataset that passed is recorded in the cache. The dataset then goes to a column
+        store and only its path is passed on: steps and foreach tasks downstream open it memory
+        mapped and share one copy of the data instead of unpickling their own.
+        """
+        self.validation, self.store_path = None, None
+        validate = self.validate_output and not self.cache_hit and self.output_path
+        columns_path = store_path(self.output_dir, self.file_name)
+        ## in incremental mode only the days just appended are validated and added to the store
+        new_rows = None
+        if self.appended_after is not None and self.output_path and (validate or self.column_store):
+            new_rows = read_date_range(self.output_path, DATE_COLUMN, start_date=pd.Timestamp(self.appended_after) + pd.Timedelta(days=1),
+                                       compact=True, assume_sorted=True)
+
+        if validate:
+            ## streamed chunk by chunk, or only the days just appended
+            chunks = [new_rows] if new_rows is not None else read_chunks(self.output_path, self.chunk_size or 1_000_000, compact=True)
+            report = validate_chunks(chunks)
+            report.log()
+            self.validation = report.summary()
+            if not report.passed:
+                raise ValueError(f"Validation of {self.output_path} failed, see the violations above")
+        if self.column_store and self.output_path:
+            if new_rows is not None and os.path.exists(columns_path):
+                if len(new_rows):
+                    ColumnStore(columns_path).append(new_rows)
+            elif not (self.cache_hit and os.path.exists(columns_path)):
+                ## the whole dataset was (re)generated, or there is no store to extend yet
+                ColumnStore.write(read_dataset(self.output_path, compact=True), columns_path)
+            self.store_path = columns_path
+
+        if self.cache_key and not self.cache_hit and self.output_path:
+            cache = GenerationCache(os.path.join(self.output_dir, '.cache'))
+            self.data_ref = cache.record(self.cache_key, self.generator_params, self.output_path)
         self.next(self.end)
 
     @step
@@ -0,0 +1,92 @@
+from metaflow import FlowSpec, step, Parameter
+from config.config import INFERENCE_CONFIG, TRAINING_CONFIG
+from src.nodes.columnar import ColumnStore, store_path
+from src.nodes.inference import MODES, route_curves, write_curves
+from src.nodes.model_registry import ModelRegistry
+from loguru import logger
+
+
+class InferenceFlow(FlowSpec):
+
+    input_data_dir = Parameter(
+        'input_data_dir',
+        default=INFERENCE_CONFIG.input_data_dir,
+        type=str,
+        help='Directory of the column store written by DataGenFlow'
+    )
+
+    input_filename = Parameter(
+        'input_filename',
+        default=INFERENCE_CONFIG.input_filename,
+        type=str,
+        help='Name of the generated dataset the column store was written for'
+    )
+
+    models_dir = Parameter(
+        'models_dir',
+        default=INFERENCE_CONFIG.models_dir,
+        type=str,
+        help='Model registry written by TrainFlow'
+    )
+
+    output_dir = Parameter(
+        'output_dir',
+        default=INFERENCE_CONFIG.output_dir,
+        type=str,
+        help='Directory of the parquet file with every curve'
+    )
+
+    mode = Parameter(
+        'mode',
+        default=INFERENCE_CONFIG.mode,
+        type=str,
+        help='per_route uses the best model of every route, global the global model'
+    )
+
+    horizons = Parameter(
+        'horizons',
+        default=','.join(str(horizon) for horizon in INFERENCE_CONFIG.horizons),
+        type=str,
+        help='Comma separated horizons in days, every curve covers the longest one'
+    )
+
+    cutoff_date = Parameter(
+        'cutoff_date',
+        default=INFERENCE_CONFIG.cutoff_date,
+        type=str,
+        help='Last day of history the curves start after, the last day of the data when empty'
+    )
+
+    @step
+    def start(self):
+        if self.mode not in MODES:
+            raise ValueError(f"Mode {self.mode} not supported, choose one of {MODES}")
+        self.horizon_days = sorted(int(horizon) for horizon in self.horizons.split(','))
+        self.next(self.predict_curves)
+
+    @step
+    def predict_curves(self):
+        """
+        Forecast every route and horizon in one pass and write all the curves to one parquet file
+        """
+        data = ColumnStore(store_path(self.input_data_dir, self.input_filename))
+        columns = [TRAINING_CONFIG.date_column, *TRAINING_CONFIG.group_columns, TRAINING_CONFIG.target_column]
+        self.curves = route_curves(
+            data.to_frame(columns),
+            ModelRegistry(self.models_dir),
+            horizons=tuple(self.horizon_days),
+            mode=self.mode,
+            cutoff_date=self.cutoff_date or None,
+            target_column=TRAINING_CONFIG.target_column,
+            group_columns=tuple(TRAINING_CONFIG.group_columns),
+            date_column=TRAINING_CONFIG.date_column,
+            lags=tuple(TRAINING_CONFIG.lags),
+            rolling_windows=tuple(TRAINING_CONFIG.rolling_windows)
+        )
+        self.output_path = write_curves(self.curves, self.output_dir)
+        self.next(self.end)
+
+    @step
+    def end(self):
+        logger.info(f"{self.curves['unique_id'].nunique()} curves of {self.curves['step'].max()} days written to {self.output_path}")
+        logger.info(f"Mean forecast per horizon: {self.curves.groupby('horizon')['y_hat'].mean().round(2).to_dict()}")
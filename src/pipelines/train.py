@@ -0,0 +1,191 @@
+from metaflow import FlowSpec, step, Parameter
+from config.config import TRAINING_CONFIG
+from src.nodes.columnar import ColumnStore, store_path
+from src.nodes.model_registry import GLOBAL_ID, ModelRegistry
+from src.nodes.training import GlobalTrainer, RouteTrainer, TrainingResult, build_training_frame, route_series
+from loguru import logger
+import os
+import pandas as pd
+
+
+class TrainFlow(FlowSpec):
+
+    input_data_dir = Parameter(
+        'input_data_dir',
+        default=TRAINING_CONFIG.input_data_dir,
+        type=str,
+        help='Directory of the column store written by DataGenFlow'
+    )
+
+    input_filename = Parameter(
+        'input_filename',
+        default=TRAINING_CONFIG.input_filename,
+        type=str,
+        help='Name of the generated dataset the column store was written for'
+    )
+
+    features_dir = Parameter(
+        'features_dir',
+        default=TRAINING_CONFIG.features_dir,
+        type=str,
+        help='Directory of the feature store shared by the training workers'
+    )
+
+    mode = Parameter(
+        'mode',
+        default=TRAINING_CONFIG.mode,
+        type=str,
+        help='per_route trains models for every route, global a single model over every route'
+    )
+
+    models = Parameter(
+        'models',
+        default=','.join(TRAINING_CONFIG.models),
+        type=str,
+        help='Comma separated models trained for every route: linear, ridge, gbm'
+    )
+
+    global_model = Parameter(
+        'global_model',
+        default=TRAINING_CONFIG.global_model,
+        type=str,
+        help='Model of the global mode: ridge or gbm'
+    )
+
+    horizon_days = Parameter(
+        'horizon_days',
+        default=TRAINING_CONFIG.horizon_days,
+        type=int,
+        help='Last days of each series held out to validate its models'
+    )
+
+    routes_per_batch = Parameter(
+        'routes_per_batch',
+        default=TRAINING_CONFIG.routes_per_batch,
+        type=int,
+        help='Routes trained per batch by a worker process, 0 sizes the batches from the workers'
+    )
+
+    num_workers = Parameter(
+        'num_workers',
+        default=TRAINING_CONFIG.num_workers,
+        type=int,
+        help='Worker processes per pod, 0 uses every CPU available to the pod'
+    )
+
+    models_dir = Parameter(
+        'models_dir',
+        default=TRAINING_CONFIG.models_dir,
+        type=str,
+        help='Model registry the trained models are saved to'
+    )
+
+    num_pods = Parameter(
+        'num_pods',
+        default=TRAINING_CONFIG.num_pods,
+        type=int,
+        help='Number of foreach tasks splitting the routes, each with its own worker pool'
+    )
+
+    @step
+    def start(self):
+        """
+        Build the training data of every route once, into a column store the workers share: the
+        features of every route in per_route mode, the daily series the global model computes its
+        features from in global mode
+        """
+        if self.mode not in ('per_route', 'global'):
+            raise ValueError(f"Mode {self.mode} not supported, choose per_route or global")
+
+        data = ColumnStore(store_path(self.input_data_dir, self.input_filename))
+        columns = [TRAINING_CONFIG.date_column, *TRAINING_CONFIG.group_columns, TRAINING_CONFIG.target_column]
+        params = dict(
+            target_column=TRAINING_CONFIG.target_column,
+            group_columns=tuple(TRAINING_CONFIG.group_columns),
+            date_column=TRAINING_CONFIG.date_column
+        )
+        if self.mode == 'global':
+            training_data = route_series(data.to_frame(columns), **params)
+        else:
+            training_data = build_training_frame(
+                data.to_frame(columns),
+                lags=tuple(TRAINING_CONFIG.lags),
+                rolling_windows=tuple(TRAINING_CONFIG.rolling_windows),
+                num_threads=TRAINING_CONFIG.num_threads,
+                **params
+            )
+        os.makedirs(self.features_dir, exist_ok=True)
+        self.features_path = ColumnStore.write(training_data, store_path(self.features_dir, self.input_filename)).path
+        ## a global model is a single fit, with no routes to split over pods
+        self.shards = list(range(self.num_pods)) if self.mode == 'per_route' else [0]
+        self.next(self.train_routes, foreach='shards')
+
+    @step
+    def train_routes(self):
+        """
+        Train the models of this task's routes, batched over a process pool, or the global model
+        validated on the last horizon days of every route and refitted on the whole series
+        """
+        self.shard = self.input
+        if self.mode == 'global':
+            series = ColumnStore(self.features_path).to_frame()
+            trainer = GlobalTrainer(
+                self.global_model,
+                lags=tuple(TRAINING_CONFIG.lags),
+                rolling_windows=tuple(TRAINING_CONFIG.rolling_windows),
+                static_columns=tuple(TRAINING_CONFIG.group_columns),
+                num_threads=TRAINING_CONFIG.num_threads
+            )
+            self.metrics = trainer.validate(series, self.horizon_days)
+            self.global_forecaster, self.route_models = trainer.fit(series), {}
+        else:
+            trainer = RouteTrainer(
+                models=tuple(self.models.split(',')),
+                horizon=self.horizon_days,
+                routes_per_batch=self.routes_per_batch,
+                num_workers=self.num_workers,
+                lags=tuple(TRAINING_CONFIG.lags),
+                rolling_windows=tuple(TRAINING_CONFIG.rolling_windows)
+            )
+            result = trainer.fit(self.features_path, shard=self.shard, num_shards=self.num_pods)
+            self.global_forecaster, self.route_models, self.metrics = None, result.models, result.metrics
+        self.next(self.join_routes)
+
+    @step
+    def join_routes(self, inputs):
+        """
+        Save every trained model to the registry, new versions of the models already there; only
+        the registry path and the metrics go on as artifacts
+        """
+        result = TrainingResult.merge([TrainingResult(task.route_models, task.metrics) for task in inputs])
+        self.merge_artifacts(inputs, exclude=['shard', 'route_models', 'metrics', 'global_forecaster'])
+        params = {'mode': self.mode, 'horizon_days': self.horizon_days, 'features_path': self.features_path}
+        metric_columns = ['mae', 'rmse', 'mape']
+
+        global_forecaster = inputs[0].global_forecaster
+        if global_forecaster is None and not result.models:
+            raise ValueError(
+                f"No route produced a model: every series is shorter than its training rows plus the "
+                f"{self.horizon_days} validation days, generate a longer history or lower horizon_days"
+            )
+        if global_forecaster is not None:
+            records = [(GLOBAL_ID, global_forecaster.model, global_forecaster, result.metrics[metric_columns].mean().to_dict(), params)]
+        else:
+            metrics = result.metrics.set_index(['unique_id', 'model'])[metric_columns]
+            records = (
+                (series_id, model_name, model, metrics.loc[(series_id, model_name)].to_dict(), params)
+                for (series_id, model_name), model in result.models.items()
+            )
+        entries = ModelRegistry(self.models_dir).register_many(records)
+        self.registered = pd.DataFrame(entries)[['unique_id', 'model', 'version', 'path']]
+        self.metrics = result.metrics
+        self.best_models = result.best()
+        self.next(self.end)
+
+    @step
+    def end(self):
+        if self.mode == 'global':
+            logger.info(f"Trained one global {self.global_model} model over {len(self.best_models)} routes")
+        else:
+            logger.info(f"Trained {len(self.registered)} route models, best model counts: {self.best_models['model'].value_counts().to_dict()}")
+        logger.info(f"Mean validation metrics of the best models: {self.best_models[['mae', 'rmse', 'mape']].mean().round(3).to_dict()}")
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src.nodes.preprocessing import RouteAggregator
+
+
+def _operations(route, commodity):
+    return pd.DataFrame({
+        'operation_date': pd.to_datetime(['2024-01-01', '2024-01-01', '2024-01-02']),
+        'route': route,
+        'commodity': commodity,
+        'value_per_ton': [1.0, 2.0, 3.0]
+    })
+
+
+def test_route_aggregator_counts_and_sums():
+    panel = RouteAggregator(value_columns=('value_per_ton',)).transform(_operations(['a', 'b', 'a'], ['x', 'x', 'x']))
+
+    assert list(panel.keys['route']) == ['a', 'b']
+    np.testing.assert_array_equal(panel.count, [[1, 1], [1, 0]])
+    np.testing.assert_array_equal(panel.sums['value_per_ton'], [[1.0, 3.0], [2.0, 0.0]])
+
+
+@pytest.mark.parametrize('categorical', [False, True])
+def test_route_aggregator_rejects_missing_group_values(categorical):
+    df = _operations(['a', None, 'a'], ['x', 'x', 'x'])
+    if categorical:
+        df['route'] = df['route'].astype('category')
+
+    with pytest.raises(ValueError, match='route'):
+        RouteAggregator(value_columns=('value_per_ton',)).transform(df)